@@ -1,3 +1,6 @@
 __version__ = "0.0.4"
 from .wmanager import *
 from .core import *
+from .asyncmanager import *
+from .inventory import *
+from .ledger import *
@@ -0,0 +1,149 @@
+import asyncio
+import weakref
+import pandas as pd
+from firecloud.fccore import __fcconfig as fcconfig
+from .session import get_session, RequestPolicy
+from .wmanager import _get_entity_status, _entities_to_df, _get_stats
+
+# asyncio counterpart of the read-only WorkspaceManager methods (requires aiohttp)
+
+
+# one connection pool per event loop
+_ASYNC_SESSIONS = weakref.WeakKeyDictionary()
+
+
+def get_async_session(pool_size=100, timeout=300):
+    """Get the aiohttp session shared by all AsyncWorkspaceManagers on the running loop"""
+    import aiohttp
+    loop = asyncio.get_event_loop()
+    session = _ASYNC_SESSIONS.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size),
+            timeout=aiohttp.ClientTimeout(total=timeout))
+        _ASYNC_SESSIONS[loop] = session
+    return session
+
+
+async def close_async_session():
+    """Close the shared aiohttp session of the running loop"""
+    session = _ASYNC_SESSIONS.pop(asyncio.get_event_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+class AsyncWorkspaceManager(object):
+    """
+    Non-blocking access to workspace entities, submissions and workflow metadata
+
+    root_url:       FireCloud API URL (default: FISS configuration)
+    token_provider: callable returning an access token (default: shared dalmatian session)
+    session:        aiohttp.ClientSession (default: pool shared per event loop)
+    max_concurrency: maximum number of concurrent requests issued by this manager
+    """
+    def __init__(self, namespace, workspace=None, timezone='America/New_York', root_url=None,
+                 token_provider=None, session=None, policy=None, max_concurrency=20):
+        if workspace is None:
+            self.namespace, self.workspace = namespace.split('/')
+        else:
+            self.namespace = namespace
+            self.workspace = workspace
+        self.timezone = timezone
+        self.root_url = root_url if root_url is not None else fcconfig.root_url
+        if not self.root_url.endswith('/'):
+            self.root_url += '/'
+        self.token_provider = token_provider if token_provider is not None else lambda: get_session().get_token()
+        self._session = session
+        self.policy = policy if policy is not None else RequestPolicy()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+
+    async def _get(self, uri, params=None):
+        """GET request with retries on 429/5xx; returns parsed JSON"""
+        session = self._session if self._session is not None else get_async_session()
+        url = self.root_url + uri
+        attempt = 0
+        while True:
+            async with self._semaphore:
+                headers = {'Authorization': 'Bearer {}'.format(self.token_provider())}
+                async with session.get(url, params=params, headers=headers) as r:
+                    if r.status==200:
+                        return await r.json()
+                    text = await r.text()
+                    retry_after = r.headers.get('Retry-After')
+            if not self.policy.should_retry('GET', r.status) or attempt>=self.policy.max_retries:
+                raise ValueError('GET {} failed ({}): {}'.format(url, r.status, text))
+            if retry_after is not None:
+                try:
+                    wait = min(float(retry_after), self.policy.max_backoff)
+                except ValueError:
+                    wait = self.policy.get_backoff(attempt)
+            else:
+                wait = self.policy.get_backoff(attempt)
+            await asyncio.sleep(wait)
+            attempt += 1
+
+
+    async def get_workflow_metadata(self, submission_id, workflow_id):
+        """Get metadata JSON for a specific workflow"""
+        return await self._get('workspaces/{}/{}/submissions/{}/workflows/{}'.format(
+            self.namespace, self.workspace, submission_id, workflow_id))
+
+
+    async def get_submission(self, submission_id):
+        """Get submission metadata"""
+        return await self._get('workspaces/{}/{}/submissions/{}'.format(
+            self.namespace, self.workspace, submission_id))
+
+
+    async def list_submissions(self, config=None):
+        """List all submissions from workspace"""
+        submissions = await self._get('workspaces/{}/{}/submissions'.format(self.namespace, self.workspace))
+        if config is not None:
+            submissions = [s for s in submissions if config in s['methodConfigurationName']]
+        return submissions
+
+
+    async def _get_entities_query(self, etype, page, page_size=1000):
+        """Async equivalent of firecloud.api.get_entities_query"""
+        return await self._get('workspaces/{}/{}/entityQuery/{}'.format(self.namespace, self.workspace, etype),
+            params={'page':page, 'pageSize':page_size, 'sortDirection':'asc'})
+
+
+    async def get_entities(self, etype, page_size=1000):
+        """Paginated query (pages after the first are fetched concurrently)"""
+        r = await self._get_entities_query(etype, 1, page_size=page_size)
+        total_pages = r['resultMetadata']['filteredPageCount']
+        all_entities = r['results']
+        pages = await asyncio.gather(*[self._get_entities_query(etype, page, page_size=page_size)
+            for page in range(2, total_pages+1)])
+        for r in pages:
+            all_entities.extend(r['results'])
+        return _entities_to_df(etype, all_entities)
+
+
+    async def get_samples(self):
+        """Get DataFrame with samples and their attributes"""
+        df = await self.get_entities('sample')
+        df['participant'] = df['participant'].apply(lambda x: x['entityName'])
+        return df
+
+
+    async def get_entity_status(self, etype, config):
+        """Get status of latest submission for the entity type in the workspace"""
+        submissions = await self.list_submissions(config=config)
+        submissions = [s for s in submissions if s['submissionEntity']['entityType']==etype]
+        r = await asyncio.gather(*[self.get_submission(s['submissionId']) for s in submissions])
+        submission_dict = {s['submissionId']:i for s,i in zip(submissions, r)}
+        return _get_entity_status(etype, submissions, submission_dict)
+
+
+    async def get_stats(self, status_df, workflow_name=None):
+        """
+        For a list of submissions, calculate time, preemptions, etc
+        """
+        status_df = status_df[status_df['status']=='Succeeded'].copy()
+        r = await asyncio.gather(*[self.get_workflow_metadata(row['submission_id'], row['workflow_id'])
+            for _,row in status_df.iterrows()])
+        metadata_dict = dict(zip(status_df.index, r))
+        return _get_stats(status_df, metadata_dict, self.timezone)
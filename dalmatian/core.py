@@ -1,16 +1,28 @@
 # Author: Francois Aguet
 from __future__ import print_function
-import os, sys, json
+import os, sys, json, re
+import time
 import subprocess
 from datetime import datetime
-from collections import Iterable
 import pandas as pd
 import numpy as np
 import firecloud.api
 import iso8601
-import binascii, base64
+import hashlib
+import mmap
 import argparse
 import multiprocessing as mp
+import threading
+import queue
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from .session import get_session, configure_session, get_cloud_session, configure_cloud_session
+from .storage import get_storage_backend, set_storage_backend, GCSBackend, LocalBackend
+from .pricing import get_price_table, set_price_table, PriceTable
+
+# route all firecloud.api calls through the shared dalmatian session
+# (credentials and user ID are resolved on first use)
+get_session()
 
 # Collection of high-level wrapper functions for FireCloud API
 
@@ -18,8 +30,49 @@ import multiprocessing as mp
 #------------------------------------------------------------------------------
 #  Helper functions for processing timestamps
 #------------------------------------------------------------------------------
+# parsed timestamps are memoized (metadata repeats the same strings many times)
+_TIME_CACHE = {}
+_TIME_CACHE_SIZE = 1000000
+
+
+def _parse_times(x):
+    """Parse list of ISO 8601 timestamps in bulk (epoch times, s)"""
+    x = pd.Series(x, dtype=object)
+    try:
+        t = pd.to_datetime(x, utc=True, format='ISO8601')
+    except (TypeError, ValueError):  # pandas<2.0 or non-standard strings
+        t = pd.to_datetime([iso8601.parse_date(i) for i in x], utc=True)
+    return np.asarray((pd.DatetimeIndex(t) - pd.Timestamp(0, tz='UTC')).total_seconds(), dtype=float)
+
+
+def convert_times(x):
+    """Convert list of ISO 8601 timestamps to array of epoch times (s); missing values are NaN"""
+    global _TIME_CACHE
+    x = list(x)
+    cache = _TIME_CACHE
+    missing = list({i for i in x if isinstance(i, str) and i not in cache})
+    if missing:
+        parsed = dict(zip(missing, _parse_times(missing)))
+        if len(cache)+len(parsed)>_TIME_CACHE_SIZE:
+            cache = {i:cache[i] for i in set(x) if isinstance(i, str) and i in cache}
+            _TIME_CACHE = cache
+        cache.update(parsed)
+    return np.array([cache.get(i, np.nan) if isinstance(i, str) else np.nan for i in x], dtype=float)
+
+
 def convert_time(x):
-    return datetime.timestamp(iso8601.parse_date(x))
+    t = _TIME_CACHE.get(x)
+    if t is None:
+        t = convert_times([x])[0]
+    return t
+
+
+def format_times(t, fmt, timezone=None):
+    """Format epoch times (s) as strings in timezone (default: UTC)"""
+    t = pd.to_datetime(pd.Series(t, dtype=float), unit='s', utc=True)
+    if timezone is not None:
+        t = t.dt.tz_convert(timezone)
+    return list(t.dt.strftime(fmt))
 
 
 def workflow_time(workflow):
@@ -29,204 +82,621 @@ def workflow_time(workflow):
     if 'end' in workflow:
         return convert_time(workflow['end']) - convert_time(workflow['start'])
     else:
-        return np.NaN
+        return np.nan
+
+
+def workflow_times(workflows):
+    """Bulk version of workflow_time (array, s)"""
+    return convert_times([w.get('end') for w in workflows]) - convert_times([w.get('start') for w in workflows])
 
 
 #------------------------------------------------------------------------------
-#  Wrapper functions for gsutil calls
+#  Functions for managing bucket contents (via the storage backend)
 #------------------------------------------------------------------------------
-def gs_list_bucket_files(bucket_id, path=None, ext=None):
-    """Get list of all files stored in bucket"""
+def _map_threads(func, items, num_threads=50):
+    """Apply func to items using a thread pool; returns list of results"""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(func, items))
+
+
+def gs_iter_bucket_files(bucket_id, path=None, ext=None, num_threads=1, queue_size=10000):
+    """
+    Iterate over all files stored in bucket, yielding dicts with
+    path, size, md5, generation, and updated as the listing progresses
+
+    num_threads: if >1, the listing is sharded by top-level prefix
+                 and the shards are listed concurrently (unordered output)
+    """
     if path is None:
-        s = subprocess.check_output('gsutil ls gs://{}/**'.format(bucket_id), shell=True)
+        prefix = 'gs://{}/'.format(bucket_id)
     else:
-        s = subprocess.check_output(os.path.join('gsutil ls gs://{}'.format(bucket_id), path, '**'), shell=True)
-    s = s.decode().strip().split('\n')
-    if ext is not None:
-        s = [i for i in s if i.endswith(ext)]
-    return s
+        prefix = os.path.join('gs://{}'.format(bucket_id), path, '')
+    backend = get_storage_backend()
+
+    if num_threads<=1:
+        for i in backend.list(prefix):
+            if ext is None or i['path'].endswith(ext):
+                yield i
+        return
+
+    # objects at the top level, then one shard per top-level prefix
+    for i in backend.list(prefix, delimiter='/'):
+        if ext is None or i['path'].endswith(ext):
+            yield i
+    shards = list(backend.list_prefixes(prefix))
+    q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def _put(x):
+        while not stop.is_set():
+            try:
+                q.put(x, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _list_shard(shard):
+        try:
+            for i in backend.list(shard):
+                if (ext is None or i['path'].endswith(ext)) and not _put(i):
+                    return
+        except Exception as e:
+            _put(e)
+        finally:
+            _put(done)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for shard in shards:
+            executor.submit(_list_shard, shard)
+        try:
+            finished = 0
+            while finished<len(shards):
+                i = q.get()
+                if i is done:
+                    finished += 1
+                elif isinstance(i, Exception):
+                    raise i
+                else:
+                    yield i
+        finally:
+            stop.set()
+
+
+def gs_list_bucket_files(bucket_id, path=None, ext=None, num_threads=1):
+    """Get list of all files stored in bucket"""
+    return [i['path'] for i in gs_iter_bucket_files(bucket_id, path=path, ext=ext, num_threads=num_threads)]
 
 
-def gs_delete(file_list, chunk_size=500):
+def _copy_file(source_path, dest_path):
+    """Copy between bucket and/or local paths"""
+    backend = get_storage_backend()
+    if source_path.startswith('gs://') and dest_path.startswith('gs://'):
+        backend.copy(source_path, dest_path)
+    elif source_path.startswith('gs://'):
+        backend.download(source_path, dest_path)
+    else:
+        backend.upload(source_path, dest_path)
+
+
+def _transfer_object(op, source_path, dest_path):
+    """Run a single transfer operation ('copy', 'move', or 'delete')"""
+    backend = get_storage_backend()
+    if op=='copy':
+        _copy_file(source_path, dest_path)
+    elif op=='move':
+        if source_path.startswith('gs://') and dest_path.startswith('gs://'):
+            backend.move(source_path, dest_path)
+        else:
+            _copy_file(source_path, dest_path)
+            if source_path.startswith('gs://'):
+                backend.delete(source_path)
+            else:
+                os.remove(source_path)
+    elif op=='delete':
+        try:
+            backend.delete(source_path)
+        except Exception:
+            if backend.exists(source_path):
+                raise
+            # already deleted (e.g., by an interrupted run)
+    else:
+        raise ValueError('Unsupported operation: {}'.format(op))
+
+
+def gs_transfer(manifest_df, journal_path=None, chunk_size=500, num_threads=50):
+    """
+    Resumable bulk copy/move/delete
+
+    manifest_df: pd.DataFrame with columns 'source', 'dest', 'op' ('copy', 'move', 'delete';
+                 dest is ignored for 'delete')
+    journal_path: TSV file recording the completion of each object. Objects
+                  recorded as done in an existing journal are skipped, so an
+                  interrupted transfer can be resumed by rerunning with the same journal.
+
+    Returns manifest_df with 'status' ('done', 'skipped', 'failed') and 'error' columns
+    """
+    result_df = manifest_df[['source', 'dest', 'op']].copy()
+    result_df['dest'] = result_df['dest'].fillna('')
+    result_df['status'] = 'pending'
+    result_df['error'] = ''
+
+    if journal_path is not None and os.path.exists(journal_path):
+        journal_df = pd.read_csv(journal_path, sep='\t', dtype=str, keep_default_na=False)
+        done = set(zip(*[journal_df.loc[journal_df['status']=='done', c] for c in ['op', 'source', 'dest']]))
+        skip = [k in done for k in zip(result_df['op'], result_df['source'], result_df['dest'])]
+        result_df.loc[skip, 'status'] = 'skipped'
+        print('Resuming transfer: {} of {} objects already completed.'.format(np.sum(skip), result_df.shape[0]))
+
+    journal = None
+    if journal_path is not None:
+        write_header = not os.path.exists(journal_path)
+        journal = open(journal_path, 'a')
+        if write_header:
+            journal.write('op\tsource\tdest\tstatus\terror\ttime\n')
+            journal.flush()
+    lock = threading.Lock()
+
+    def _run(i):
+        op, source_path, dest_path = result_df.loc[i, ['op', 'source', 'dest']]
+        try:
+            _transfer_object(op, source_path, dest_path)
+            status, error = 'done', ''
+        except Exception as e:
+            status, error = 'failed', '{}: {}'.format(type(e).__name__, e).replace('\t', ' ').replace('\n', ' ')
+        if journal is not None:
+            with lock:  # record each object as soon as it completes
+                journal.write('\t'.join([op, source_path, dest_path, status, error, datetime.now().isoformat()])+'\n')
+                journal.flush()
+        return status, error
+
+    # one job per object; chunk_size only sets how often progress is printed
+    try:
+        ix = result_df.index[result_df['status']=='pending']
+        results = []
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for k,r in enumerate(executor.map(_run, ix), 1):
+                results.append(r)
+                if k%chunk_size==0 or k==len(ix):
+                    print('\rTransferred {}/{} objects'.format(k, len(ix)), end='')
+        if len(ix)>0:
+            result_df.loc[ix, ['status', 'error']] = results
+            print()
+    finally:
+        if journal is not None:
+            journal.close()
+
+    failed = (result_df['status']=='failed').sum()
+    if failed>0:
+        print('{} of {} objects failed.'.format(failed, result_df.shape[0]))
+    return result_df
+
+
+def _check_transfer(result_df, op):
+    if (result_df['status']=='failed').any():
+        raise ValueError('{} failed for {} files (see journal or returned table).'.format(
+            op.capitalize(), (result_df['status']=='failed').sum()))
+
+
+def gs_delete(file_list, chunk_size=500, num_threads=50, journal_path=None):
     """Delete list of files (paths starting with gs://)"""
-    # number of calls is limited by command line size limit
-    n = int(np.ceil(len(file_list)/chunk_size))
-    for i in range(n):
-        x = file_list[chunk_size*i:chunk_size*(i+1)]
-        cmd = 'echo -e "{}" | gsutil -m rm -I'.format('\n'.join(x))
-        subprocess.call(cmd, shell=True)
+    manifest_df = pd.DataFrame({'source':list(file_list), 'dest':'', 'op':'delete'})
+    result_df = gs_transfer(manifest_df, journal_path=journal_path, chunk_size=chunk_size, num_threads=num_threads)
+    _check_transfer(result_df, 'delete')
+    return result_df
 
 
-def gs_copy(file_list, dest_dir, chunk_size=500):
+def gs_copy(file_list, dest_dir, chunk_size=500, num_threads=50, journal_path=None):
     """Copy list of files (paths starting with gs://)"""
-    n = int(np.ceil(len(file_list)/chunk_size))
-    for i in range(n):
-        x = file_list[chunk_size*i:chunk_size*(i+1)]
-        cmd = 'echo -e "{}" | gsutil -m cp -I {}'.format('\n'.join(x), dest_dir)
-        subprocess.check_call(cmd, shell=True)
+    manifest_df = pd.DataFrame({'source':list(file_list), 'op':'copy'})
+    manifest_df['dest'] = [os.path.join(dest_dir, os.path.basename(p)) for p in manifest_df['source']]
+    result_df = gs_transfer(manifest_df, journal_path=journal_path, chunk_size=chunk_size, num_threads=num_threads)
+    _check_transfer(result_df, 'copy')
+    return result_df
 
 
-def gs_move(file_list, dest_dir, chunk_size=500):
+def gs_move(file_list, dest_dir, chunk_size=500, num_threads=50, journal_path=None):
     """Move list of files (paths starting with gs://)"""
-    n = int(np.ceil(len(file_list)/chunk_size))
-    for i in range(n):
-        x = file_list[chunk_size*i:chunk_size*(i+1)]
-        cmd = 'echo -e "{}" | gsutil -m mv -I {}'.format('\n'.join(x), dest_dir)
-        subprocess.check_call(cmd, shell=True)
-
-
-def _gsutil_cp_wrapper(args):
-    """gsutil cp wrapper for gs_par_upload"""
-    source_path = args[0]
-    dest_path = args[1]
-    filename = os.path.basename(dest_path)
-    print('Starting copy: '+filename, flush=True)
-    st = datetime.now()
-    subprocess.check_call('gsutil cp {} {}'.format(source_path, dest_path), shell=True)
-    et = datetime.now()
-    time_min = (et-st).total_seconds()/60
-    size_gb = os.path.getsize(source_path)/1024**3
-    print('Finished copy: {}. size: {:.2f} GB, time elapsed: {:.2f} min.'.format(filename, size_gb, time_min), flush=True)
-    # return time_min, size_gb
-
-
-def gs_copy_par(source_paths, dest_paths, num_threads=10):
-    """Parallel gsutil cp"""
+    manifest_df = pd.DataFrame({'source':list(file_list), 'op':'move'})
+    manifest_df['dest'] = [os.path.join(dest_dir, os.path.basename(p)) for p in manifest_df['source']]
+    result_df = gs_transfer(manifest_df, journal_path=journal_path, chunk_size=chunk_size, num_threads=num_threads)
+    _check_transfer(result_df, 'move')
+    return result_df
+
+
+def _file_size(path):
+    """Size of a local file or bucket object (NaN if missing)"""
+    if path.startswith('gs://'):
+        r = get_storage_backend().stat(path)
+        return r['size'] if r is not None else np.nan
+    elif os.path.exists(path):
+        return os.path.getsize(path)
+    return np.nan
+
+
+def gs_copy_par(source_paths, dest_paths, num_threads=10, max_retries=3, backoff=5):
+    """
+    Parallel copy (e.g., upload of local files to gs:// paths)
+
+    Files are copied largest first by a bounded thread pool; each file is
+    retried up to max_retries times.
+
+    Returns a DataFrame with size, time, attempts, and status for each file.
+    """
     assert len(source_paths)==len(dest_paths)
-    res_list = []
-    print('Starting cp pool ({} threads)'.format(num_threads), flush=True)
-    with mp.Pool(processes=int(num_threads)) as pool:
-        for i in range(len(source_paths)):
-            res = pool.map_async(_gsutil_cp_wrapper, ((source_paths[i], dest_paths[i], ),))
-            res_list.append(res)
-        pool.close()
-        pool.join()
-    print('Finished upload.', flush=True)
-    # res = np.array([i.get()[0] for i in res_list])
-    # return res[:,0], res[:,1]
+    res_df = pd.DataFrame({'source':list(source_paths), 'dest':list(dest_paths)})
+    res_df['size_bytes'] = _map_threads(_file_size, res_df['source'].tolist(), num_threads=num_threads)
+    res_df = res_df.sort_values('size_bytes', ascending=False, na_position='last')
+    total_gb = res_df['size_bytes'].sum()/1024**3
+
+    lock = threading.Lock()
+    progress = {'files':0, 'bytes':0}
+    st = time.time()
+
+    def _copy(args):
+        source_path, dest_path, size = args
+        t = time.time()  # includes all attempts
+        for attempt in range(1, max_retries+2):
+            try:
+                _copy_file(source_path, dest_path)
+                status, error = 'done', ''
+                break
+            except Exception as e:
+                status, error = 'failed', '{}: {}'.format(type(e).__name__, e)
+                if attempt<=max_retries:
+                    time.sleep(backoff*attempt)
+        elapsed = time.time()-t
+        with lock:
+            progress['files'] += 1
+            if status=='done' and pd.notnull(size):
+                progress['bytes'] += size
+            rate = progress['bytes']/1024**2/max(time.time()-st, 1e-9)
+            print('\rCopied {}/{} files ({:.2f}/{:.2f} GB, {:.1f} MB/s)'.format(
+                progress['files'], res_df.shape[0], progress['bytes']/1024**3, total_gb, rate), end='')
+        return elapsed, attempt, status, error
+
+    print('Starting copy ({} threads)'.format(num_threads), flush=True)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        r = list(executor.map(_copy, zip(res_df['source'], res_df['dest'], res_df['size_bytes'])))
+    res_df['time_s'], res_df['attempts'], res_df['status'], res_df['error'] = zip(*r) if r else ([],[],[],[])
+    elapsed = time.time()-st
+    print()
+    print('Finished copy: {:.2f} GB in {:.2f} min ({:.1f} MB/s).'.format(
+        progress['bytes']/1024**3, elapsed/60, progress['bytes']/1024**2/max(elapsed, 1e-9)), flush=True)
+    failed = (res_df['status']=='failed').sum()
+    if failed>0:
+        print('{} of {} files failed:'.format(failed, res_df.shape[0]))
+        for i in res_df.loc[res_df['status']=='failed', 'source']:
+            print('  * '+i)
+    return res_df.sort_index()
+
 
+def gs_sync(source_paths, dest_paths, checksum=True, num_threads=10, max_retries=3):
+    """
+    Incremental upload: copy local files to gs:// paths only if the
+    destination is missing or differs in size (or MD5, if checksum=True)
 
-def gs_exists(file_list_s):
+    Returns a DataFrame with the action ('uploaded', 'unchanged', 'failed') for each file.
+    """
+    assert len(source_paths)==len(dest_paths)
+    sync_df = pd.DataFrame({'source':list(source_paths), 'dest':list(dest_paths)})
+    objects = _stat_objects(sync_df['dest'].tolist(), num_threads=num_threads)
+    sync_df['size_bytes'] = [os.path.getsize(i) for i in sync_df['source']]
+    sync_df['dest_size_bytes'] = [objects[i]['size'] if i in objects else np.nan for i in sync_df['dest']]
+    changed = sync_df['size_bytes']!=sync_df['dest_size_bytes']
+
+    if checksum and not changed.all():  # compare MD5s of files with matching sizes
+        ix = sync_df.index[~changed]
+        dest_md5 = [objects[i]['md5'] for i in sync_df.loc[ix, 'dest']]
+        local_md5 = _map_threads(_md5_local, sync_df.loc[ix, 'source'].tolist(), num_threads=num_threads)
+        # composite objects have no MD5; sizes match, so they are considered unchanged
+        changed.loc[ix] = np.array([m is not None and m!=l for m,l in zip(dest_md5, local_md5)], dtype=bool)
+
+    sync_df['action'] = 'unchanged'
+    print('{} of {} files are missing or changed.'.format(changed.sum(), sync_df.shape[0]))
+    if changed.any():
+        copy_df = gs_copy_par(sync_df.loc[changed, 'source'].tolist(), sync_df.loc[changed, 'dest'].tolist(),
+            num_threads=num_threads, max_retries=max_retries)
+        sync_df.loc[changed, 'action'] = np.where(copy_df['status'].values=='done', 'uploaded', 'failed')
+    return sync_df
+
+
+def _group_by_parent(paths):
+    """Group gs:// paths by parent prefix (gs://bucket/dir/)"""
+    groups = defaultdict(set)
+    for p in paths:
+        groups[p.rsplit('/', 1)[0]+'/'].add(p)
+    return groups
+
+
+def _stat_objects(paths, num_threads=50, min_listing=5, inventory=None, max_age=None):
+    """
+    Get metadata for a list of gs:// paths (dict: path -> object metadata; missing paths are omitted)
+
+    Paths are grouped by parent prefix; prefixes with at least min_listing
+    requested paths are resolved with a single (non-recursive) listing, the
+    remaining paths are checked individually. Both run concurrently.
+
+    inventory: BucketInventory to answer from (max_age: see BucketInventory.lookup)
+    """
+    if inventory is not None:
+        return inventory.lookup(paths, max_age=max_age)
+    backend = get_storage_backend()
+    paths = [p for p in paths if isinstance(p, str) and p.startswith('gs://')]
+    groups = _group_by_parent(paths)
+    dense = [g for g,v in groups.items() if len(v)>=min_listing]
+    sparse = [p for g,v in groups.items() if len(v)<min_listing for p in v]
+
+    objects = {}
+    for r in _map_threads(lambda prefix: list(backend.list(prefix, delimiter='/')), dense, num_threads=num_threads):
+        objects.update({i['path']:i for i in r})
+    for p,r in zip(sparse, _map_threads(backend.stat, sparse, num_threads=num_threads)):
+        if r is not None:
+            objects[p] = r
+    return objects
+
+
+def gs_exists(file_list_s, num_threads=50, min_listing=5, inventory=None, max_age=None):
     """
     Check whether files exist
 
     file_list_s: pd.Series
+    min_listing, inventory, max_age: see _stat_objects
     """
-    status_s = pd.Series(False, index=file_list_s.index, name='file_exists')
-    for k,(i,p) in enumerate(zip(file_list_s.index, file_list_s), 1):
-        print('\rChecking {}/{} files'.format(k, len(file_list_s)), end='')
-        try:
-            s = subprocess.check_output('gsutil -q stat {}'.format(p), shell=True)
-            status_s[i] = True
-        except subprocess.CalledProcessError as e:
-            s = e.stdout.decode()
-            print('{}: {}'.format(i, s))
-    return status_s
+    objects = _stat_objects(file_list_s, num_threads=num_threads, min_listing=min_listing,
+        inventory=inventory, max_age=max_age)
+    return pd.Series([p in objects for p in file_list_s], index=file_list_s.index, name='file_exists')
 
 
-def gs_size(file_list_s):
+def gs_size(file_list_s, num_threads=50, min_listing=5, inventory=None, max_age=None):
     """
-    Get file sizes (in bytes)
+    Get file sizes (in bytes); NaN for missing files
 
     file_list_s: pd.Series
+    min_listing, inventory, max_age: see _stat_objects
     """
-    prefix = os.path.commonprefix(file_list_s.tolist())
-    s = subprocess.check_output('gsutil ls -l {}**'.format(prefix), shell=True)
-    gs_sizes = s.decode().strip().split('\n')[:-1]
-    gs_sizes = pd.Series([np.int64(i.split()[0]) for i in gs_sizes],
-        index=[i.split()[-1] for i in gs_sizes])
-    gs_sizes.index.name = 'path'
-    return pd.Series(gs_sizes[file_list_s].values, index=file_list_s.index, name='size_bytes')
-
-
-def _parse_stat_entry(se):
-    """parse output from 'gsutil stat'"""
-    se = se.split('\n')
-    filename = se[0].strip(':')
-    md5 = [i for i in se if 'md5' in i][0].split()[-1]
-    md5 = binascii.hexlify(base64.b64decode(md5)).decode()
-    sample_id = os.path.basename(filename).split('.')[0]
-    return sample_id, md5
-
-
-def get_md5_hashes(wildcard_path):
-    s = subprocess.check_output('gsutil stat '+wildcard_path, shell=True).decode().strip()
-    s = ['gs://'+i for i in s.split('gs://')[1:]]
-    sample_ids, md5 = np.array([_parse_stat_entry(i) for i in s]).T
+    objects = _stat_objects(file_list_s, num_threads=num_threads, min_listing=min_listing,
+        inventory=inventory, max_age=max_age)
+    return pd.Series([objects[p]['size'] if p in objects else np.nan for p in file_list_s],
+        index=file_list_s.index, name='size_bytes', dtype=np.float64)
+
+
+def _list_wildcard(wildcard_path, inventory=None):
+    """List objects matching a wildcard path (gs://bucket/path/*.bam; '*' does not match '/', '**' does)"""
+    prefix = re.split(r'[*?\[]', wildcard_path, maxsplit=1)[0]
+    pattern = ''.join('.*' if i=='**' else '[^/]*' if i=='*' else '[^/]' if i=='?' else re.escape(i)
+        for i in re.split(r'(\*\*|\*|\?)', wildcard_path))
+    pattern = re.compile(pattern+'$')
+    if inventory is not None:
+        objects = inventory.iter_objects(prefix)
+    else:
+        objects = get_storage_backend().list(prefix)
+    return [i for i in objects if pattern.match(i['path'])]
+
+
+def get_md5_hashes(wildcard_path, inventory=None):
+    """Get MD5 hashes (from object metadata) of files matching the wildcard path"""
+    s = _list_wildcard(wildcard_path, inventory=inventory)
+    sample_ids = [os.path.basename(i['path']).split('.')[0] for i in s]
+    md5 = [i['md5'] for i in s]
     return pd.Series(md5, index=sample_ids, name='md5').sort_index()
 
 
-def get_md5hash(file_path):
-    """Calculate MD5 hash using gsutil or md5sum, depending on location"""
+def _md5_local(file_path, chunk_size=64*1024**2):
+    """MD5 hash of a local file (memory-mapped reads)"""
+    h = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size==0:
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for k in range(0, len(m), chunk_size):
+                h.update(m[k:k+chunk_size])
+    return h.hexdigest()
+
+
+def _md5_stream(file_path, chunk_size=16*1024**2):
+    """MD5 hash of a bucket object, computed by streaming its content"""
+    h = hashlib.md5()
+    for chunk in get_storage_backend().iter_read(file_path, chunk_size=chunk_size):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def get_md5hash(file_path, mode='stream'):
+    """
+    Calculate MD5 hash of a bucket object or local file
+
+    mode: 'stream':   download and hash the object content
+          'metadata': use the MD5 stored in the object metadata (falls back
+                      to streaming for composite objects, which have none)
+    """
+    assert mode in ['stream', 'metadata']
     if file_path.startswith('gs://'):
-        s = subprocess.check_output('gsutil hash -m -h '+file_path, shell=True).decode()
-        s = s.strip().split('\n')
-        s = [i for i in s if 'md5' in i][0]
-        return s.split()[-1]
+        if mode=='metadata':
+            r = get_storage_backend().stat(file_path)
+            if r is None:
+                raise ValueError('File not found: {}'.format(file_path))
+            if r['md5'] is not None:
+                return r['md5']
+        return _md5_stream(file_path)
     else:
-        return subprocess.check_output('md5sum '+file_path, shell=True).decode().split()[0]
+        return _md5_local(file_path)
+
+
+def get_md5hashes(file_list_s, num_threads=10, mode='stream', inventory=None):
+    """
+    Parallelized get_md5hash()
 
+    With mode='metadata', hashes of bucket objects are read in bulk from
+    listings (or from inventory, if provided) and only objects without a
+    stored MD5 are streamed. Missing bucket objects are reported as None.
+    """
+    assert mode in ['stream', 'metadata']
+    file_list = [i for i in file_list_s]
+    md5_hashes = {}
+    if mode=='metadata':
+        objects = _stat_objects(file_list, num_threads=num_threads, inventory=inventory)
+        md5_hashes.update({i:objects[i]['md5'] for i in file_list if i in objects and objects[i]['md5'] is not None})
+        missing = {i for i in file_list if i.startswith('gs://') and i not in objects}
+        if missing:
+            print('{} files not found.'.format(len(missing)))
+            md5_hashes.update({i:None for i in missing})
+
+    def _hash(file_path):
+        if file_path.startswith('gs://'):
+            return _md5_stream(file_path)
+        else:
+            return _md5_local(file_path)
+
+    remaining = [i for i in pd.unique(np.array(file_list, dtype=object)) if i not in md5_hashes]
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for k,(i,r) in enumerate(zip(remaining, executor.map(_hash, remaining)), 1):
+            print('\rCalculating MD5 hash for file {}/{}'.format(k,len(remaining)), end='')
+            md5_hashes[i] = r
+    if remaining:
+        print()
+    return [md5_hashes[i] for i in file_list]
 
-def get_md5hashes(file_list_s, num_threads=10):
-    """Parallelized get_md5hash()"""
-    md5_hashes = []
-    with mp.Pool(processes=num_threads) as pool:
-        for k,r in enumerate(pool.imap(get_md5hash, [i for i in file_list_s]), 1):
-            print('\rCalculating MD5 hash for file {}/{}'.format(k,len(file_list_s)), end='')
-            md5_hashes.append(r)
-    return md5_hashes
+
+#------------------------------------------------------------------------------
+#  Functions for triaging failed tasks
+#------------------------------------------------------------------------------
+_ERROR_PATTERN = re.compile(r'error|exception|fatal|killed|abort|denied|not found|no such|out of memory|traceback', re.I)
+_NORMALIZE_PATTERNS = [
+    (re.compile(r'gs://\S+'), '<gs_path>'),
+    (re.compile(r'(?:/[\w.\-]+)+'), '<path>'),
+    (re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', re.I), '<uuid>'),
+    (re.compile(r'0x[0-9a-f]+|\b[0-9a-f]{16,}\b', re.I), '<hex>'),
+    (re.compile(r'\d+(?:\.\d+)?'), '<n>'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def get_error_signature(log):
+    """Normalized error signature of a log: the last line matching an error keyword (or the last line)"""
+    lines = [i.strip() for i in log.strip().split('\n') if i.strip()]
+    if not lines:
+        return '<empty>'
+    errors = [i for i in lines if _ERROR_PATTERN.search(i)]
+    s = errors[-1] if errors else lines[-1]
+    for pattern, repl in _NORMALIZE_PATTERNS:
+        s = pattern.sub(repl, s)
+    return s.strip()[:300]
+
+
+def cluster_errors(log_s, max_examples=5):
+    """
+    Cluster logs (pd.Series, indexed by entity ID or (entity ID, shard)) by normalized error signature
+
+    Returns a DataFrame with count and examples (entity IDs) for each signature
+    """
+    signature_s = log_s.apply(get_error_signature)
+    df = pd.DataFrame({
+        'count': signature_s.value_counts(),
+        'examples': signature_s.groupby(signature_s).apply(lambda x: list(x.index[:max_examples])),
+    })
+    df.index.name = 'signature'
+    return df.sort_values('count', ascending=False)
 
 
 #------------------------------------------------------------------------------
 # Functions for parsing Google metadata
 #------------------------------------------------------------------------------
-def get_google_metadata(job_id):
+GENOMICS_API_URL = 'https://genomics.googleapis.com/v1alpha2/'
+
+
+def _fetch_google_metadata(job_id, cache_dir=None):
+    """Fetch operation metadata; completed operations are cached in cache_dir"""
+    name = job_id if job_id.startswith('operations/') else 'operations/'+job_id
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, name.split('/')[-1]+'.json')
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                return json.load(f)
+    r = get_cloud_session().get(GENOMICS_API_URL+name)
+    if r.status_code!=200:
+        raise ValueError('Fetching metadata for {} failed: {}'.format(job_id, r.text))
+    j = r.json()
+    if cache_dir is not None and j.get('done', False):  # completed operations don't change
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(cache_path, threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(j, f)
+        os.replace(tmp_path, cache_path)
+    return j
+
+
+def _iter_google_metadata(job_ids, num_threads, cache_dir):
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for k,j in enumerate(executor.map(lambda x: _fetch_google_metadata(x, cache_dir=cache_dir), job_ids), 1):
+            print('\rFetching metadata ({}/{})'.format(k,len(job_ids)), end='')
+            yield j
+
+
+def get_google_metadata(job_id, num_threads=20, use_cache=True, cache_dir=None, stream=False):
     """
-    jobid: operations ID
+    jobid: operations ID, or list of IDs
+
+    Metadata is fetched from the Genomics API in-process (num_threads concurrent requests).
+    Completed operations are cached in cache_dir (default: ~/.dalmatian/operations).
+    stream: return a generator (in input order) instead of a list
     """
+    if use_cache and cache_dir is None:
+        cache_dir = os.path.join(os.path.expanduser('~'), '.dalmatian', 'operations')
+    elif not use_cache:
+        cache_dir = None
     if isinstance(job_id, str):
-        s = subprocess.check_output('gcloud alpha genomics operations describe '+job_id+' --format json', shell=True)
-        return json.loads(s.decode())
-    elif isinstance(job_id, Iterable):
-        json_list = []
-        for k,j in enumerate(job_id, 1):
-            print('\rFetching metadata ({}/{})'.format(k,len(job_id)), end='')
-            s = subprocess.check_output('gcloud alpha genomics operations describe '+j+' --format json', shell=True)
-            json_list.append(json.loads(s.decode()))
-        return json_list
+        return _fetch_google_metadata(job_id, cache_dir=cache_dir)
+    else:
+        json_list = _iter_google_metadata(list(job_id), num_threads, cache_dir)
+        return json_list if stream else list(json_list)
 
 
 def parse_google_stats(json_list):
     """
     Parse job start and end times, machine type, and preemption status from Google metadata
     """
-    df = pd.DataFrame(index=[j['name'] for j in json_list], columns=['time_h', 'machine_type', 'preemptible', 'preempted'])
+    # flatten events of all jobs, then parse all timestamps at once
+    names = [j['name'] for j in json_list]
+    event_names = []
+    event_descriptions = []
+    event_times = []
     for j in json_list:
-        event_dict = {k['description']:convert_time(k['startTime']) for k in j['metadata']['events'] if 'copied' not in k}
-        event_times = [convert_time(k['startTime']) for k in j['metadata']['events'] if 'copied' not in k]
-        time_delta = np.max(event_times) - np.min(event_times)
-        # if 'ok' in event_dict:
-        #     time_delta = convert_time(event_dict['ok']) - convert_time(event_dict['start'])
-        # elif 'start-shutdown' in event_dict:
-        #     time_delta = convert_time(event_dict['start-shutdown']) - convert_time(event_dict['start'])
-        # else:
-        #     raise ValueError('unknown event')
-        mt = j['metadata']['runtimeMetadata']['computeEngine']['machineType'].split('/')[-1]
-        p = j['metadata']['request']['ephemeralPipeline']['resources']['preemptible']
-        # j[0]['metadata']['request']['pipelineArgs']['resources']['preemptible']
-        df.loc[j['name'], ['time_h', 'machine_type', 'preemptible', 'preempted']] = [time_delta/3600, mt, p, 'ok' not in event_dict]
+        for k in j['metadata']['events']:
+            if 'copied' not in k:
+                event_names.append(j['name'])
+                event_descriptions.append(k['description'])
+                event_times.append(k['startTime'])
+    events_df = pd.DataFrame({
+        'name': event_names,
+        'ok': np.array(event_descriptions)=='ok' if event_descriptions else np.zeros(0, dtype=bool),
+        'time': convert_times(event_times),
+    })
+    g = events_df.groupby('name', sort=False)
+    time_delta = g['time'].max() - g['time'].min()
+
+    df = pd.DataFrame(index=names)
+    df['time_h'] = time_delta.reindex(names).values / 3600
+    df['machine_type'] = [j['metadata']['runtimeMetadata']['computeEngine']['machineType'].split('/')[-1] for j in json_list]
+    df['preemptible'] = [j['metadata']['request']['ephemeralPipeline']['resources']['preemptible'] for j in json_list]
+    df['preempted'] = ~g['ok'].any().reindex(names, fill_value=False).values
     return df
 
 
 def calculate_google_cost(jobid, jobid_lookup_df):
     """
     Calculate cost
+
+    jobid: job ID, or list of job IDs (returns a Series)
     """
-    r = jobid_lookup_df.loc[jobid]
-    if r['preempted'] and r['time_h']<1/6:
-        return 0
-    else:
-        return r['time_h']*get_vm_cost(r['machine_type'], preemptible=r['preemptible'])
+    if isinstance(jobid, str):
+        return calculate_google_cost([jobid], jobid_lookup_df).iloc[0]
+    df = jobid_lookup_df.loc[list(jobid)]
+    cost = get_vm_costs(df['machine_type'].values, preemptible=df['preemptible'].astype(bool).values,
+                        hours=df['time_h'].astype(float).values)
+    cost[(df['preempted'].astype(bool) & (df['time_h']<1/6)).values] = 0  # preempted within 10 min: not charged
+    return pd.Series(cost, index=df.index)
 
 
 #------------------------------------------------------------------------------
@@ -487,60 +957,18 @@ def update_method(namespace, method, synopsis, wdl_file, public=False, delete_ol
 #------------------------------------------------------------------------------
 def get_vm_cost(machine_type, preemptible=True):
     """
-    Cost per hour
-    """
-    preemptible_dict = {
-        'n1-standard-1': 0.0100,  # 3.75 GB
-        'n1-standard-2': 0.0200,  # 7.5 GB
-        'n1-standard-4': 0.0400,  # 15  GB
-        'n1-standard-8': 0.0800,  # 30  GB
-        'n1-standard-16':0.1600,  # 60  GB
-        'n1-standard-32':0.3200,  # 120 GB
-        'n1-standard-64':0.6400,  # 240 GB
-        'n1-highmem-2':  0.0250,  # 13  GB
-        'n1-highmem-4':  0.0500,  # 26  GB
-        'n1-highmem-8':  0.1000,  # 52  GB
-        'n1-highmem-16': 0.2000,  # 104 GB
-        'n1-highmem-32': 0.4000,  # 208 GB
-        'n1-highmem-64': 0.8000,  # 416 GB
-        'n1-highcpu-2':  0.0150,  # 1.80 GB
-        'n1-highcpu-4':  0.0300,  # 3.60 GB
-        'n1-highcpu-8':  0.0600,  # 7.20 GB
-        'n1-highcpu-16': 0.1200,  # 14.40 GB
-        'n1-highcpu-32': 0.2400,  # 28.80 GB
-        'n1-highcpu-64': 0.4800,  # 57.6 GB
-        'f1-micro':      0.0035,  # 0.6 GB
-        'g1-small':      0.0070,  # 1.7 GB
-    }
-
-    standard_dict = {
-        'n1-standard-1': 0.0475,
-        'n1-standard-2': 0.0950,
-        'n1-standard-4': 0.1900,
-        'n1-standard-8': 0.3800,
-        'n1-standard-16': 0.7600,
-        'n1-standard-32': 1.5200,
-        'n1-standard-64': 3.0400,
-        'n1-highmem-2':  0.1184,
-        'n1-highmem-4':  0.2368,
-        'n1-highmem-8':  0.4736,
-        'n1-highmem-16': 0.9472,
-        'n1-highmem-32': 1.8944,
-        'n1-highmem-64': 3.7888,
-        'n1-highcpu-2':  0.0709,
-        'n1-highcpu-4':  0.1418,
-        'n1-highcpu-8':  0.2836,
-        'n1-highcpu-16': 0.5672,
-        'n1-highcpu-32': 1.1344,
-        'n1-highcpu-64': 2.2688,
-        'f1-micro':      0.0076,
-        'g1-small':      0.0257,
-    }
-
-    if preemptible:
-        return preemptible_dict[machine_type]
-    else:
-        return standard_dict[machine_type]
+    Cost per hour (see PriceTable; supports predefined n1/n2/e2 and custom-N-M machine types)
+    """
+    return get_price_table().hourly_price(machine_type, preemptible=preemptible)
+
+
+def get_vm_costs(machine_types, preemptible=True, hours=1, disk_gb=None, disk_type='pd-standard'):
+    """
+    Vectorized cost calculation: cost of running machine_types for hours
+    (arrays or scalars), optionally including disk_gb of disk_type
+    """
+    return get_price_table().price(machine_types, preemptible=preemptible, hours=hours,
+                                   disk_gb=disk_gb, disk_type=disk_type)
 
 
 def main(argv=None):
@@ -0,0 +1,169 @@
+from __future__ import print_function
+import os
+import time
+import sqlite3
+import itertools
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from .core import gs_iter_bucket_files, _group_by_parent
+from .storage import get_storage_backend
+
+# Persistent (SQLite) index of bucket contents
+
+
+class BucketInventory(object):
+    """
+    Local index of the objects in a bucket (path, size, md5, generation, update time)
+
+    The index is built once with build() and refreshed per prefix with
+    refresh(prefix). Lookups can optionally refresh prefixes that are
+    older than max_age (seconds).
+
+    db_path: SQLite file (default: ~/.dalmatian/inventory/{bucket_id}.sqlite)
+    """
+    def __init__(self, bucket_id, db_path=None):
+        self.bucket_id = bucket_id
+        if db_path is None:
+            db_path = os.path.join(os.path.expanduser('~'), '.dalmatian', 'inventory', bucket_id+'.sqlite')
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._staging = itertools.count()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS objects ('
+            'path TEXT PRIMARY KEY, size INTEGER, md5 TEXT, generation INTEGER, updated TEXT)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS prefixes (prefix TEXT PRIMARY KEY, refreshed REAL)')
+        self._conn.commit()
+
+    def _prefix(self, prefix):
+        """Convert prefix relative to bucket root to gs:// prefix"""
+        if prefix.startswith('gs://'):
+            return prefix
+        return 'gs://{}/{}'.format(self.bucket_id, prefix.lstrip('/'))
+
+    def build(self, num_threads=10):
+        """Index the entire bucket"""
+        self.refresh('', num_threads=num_threads)
+
+    def refresh(self, prefix='', num_threads=10, chunk_size=10000):
+        """Re-list prefix and replace its entries in the index"""
+        gs_prefix = self._prefix(prefix)
+        path = gs_prefix[len('gs://{}/'.format(self.bucket_id)):]
+        refreshed = time.time()
+        # list into a staging table; the index is only locked while swapping in the new entries,
+        # and if listing fails, the existing entries are kept
+        staging = 'staging_{}'.format(next(self._staging))
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TEMP TABLE {} (path TEXT PRIMARY KEY, size INTEGER, md5 TEXT, '
+                'generation INTEGER, updated TEXT)'.format(staging))
+        try:
+            rows = []
+            n = 0
+            if path and not path.endswith('/'):  # single object or partial name
+                it = (i for i in gs_iter_bucket_files(self.bucket_id, path=os.path.dirname(path) or None)
+                      if i['path'].startswith(gs_prefix))
+            else:
+                it = gs_iter_bucket_files(self.bucket_id, path=path.rstrip('/') or None, num_threads=num_threads)
+            for i in it:
+                rows.append((i['path'], i['size'], i['md5'], i['generation'], i['updated'].isoformat()))
+                if len(rows)==chunk_size:
+                    with self._lock, self._conn:
+                        self._conn.executemany('INSERT OR REPLACE INTO {} VALUES (?,?,?,?,?)'.format(staging), rows)
+                    n += len(rows)
+                    rows = []
+                    print('\r  * indexed {} objects'.format(n), end='')
+            n += len(rows)
+            with self._lock, self._conn:
+                self._conn.executemany('INSERT OR REPLACE INTO {} VALUES (?,?,?,?,?)'.format(staging), rows)
+                self._conn.execute('DELETE FROM objects WHERE path>=? AND path<?', (gs_prefix, gs_prefix+'\U0010ffff'))
+                self._conn.execute('INSERT OR REPLACE INTO objects SELECT * FROM {}'.format(staging))
+                # a refreshed prefix supersedes refresh records of its sub-prefixes
+                self._conn.execute('DELETE FROM prefixes WHERE prefix>=? AND prefix<?', (gs_prefix, gs_prefix+'\U0010ffff'))
+                self._conn.execute('INSERT OR REPLACE INTO prefixes VALUES (?,?)', (gs_prefix, refreshed))
+        finally:
+            with self._lock, self._conn:
+                self._conn.execute('DROP TABLE IF EXISTS {}'.format(staging))
+        print('\r  * indexed {} objects under {}'.format(n, gs_prefix))
+
+    def last_refreshed(self, prefix):
+        """Time (epoch) at which the prefix was last covered by a refresh (None if never)"""
+        gs_prefix = self._prefix(prefix)
+        with self._lock:
+            r = self._conn.execute('SELECT prefix, refreshed FROM prefixes').fetchall()
+        r = [t for p,t in r if gs_prefix.startswith(p)]
+        return max(r) if r else None
+
+    def is_fresh(self, prefix, max_age):
+        t = self.last_refreshed(prefix)
+        return t is not None and time.time()-t<=max_age
+
+    def lookup(self, paths, max_age=None, num_threads=10):
+        """
+        Get metadata for gs:// paths (dict: path -> object metadata; missing paths are omitted)
+
+        Paths in other buckets are not indexed and are looked up directly.
+
+        max_age: refresh parent prefixes not refreshed within max_age seconds
+        """
+        paths = [p for p in paths if isinstance(p, str) and p.startswith('gs://')]
+        other = [p for p in paths if not p.startswith('gs://{}/'.format(self.bucket_id))]
+        paths = [p for p in paths if p.startswith('gs://{}/'.format(self.bucket_id))]
+        if max_age is not None:
+            for prefix in _group_by_parent(paths):
+                if not self.is_fresh(prefix, max_age):
+                    self.refresh(prefix, num_threads=num_threads)
+        objects = {}
+        with self._lock:
+            for k in range(0, len(paths), 500):
+                x = paths[k:k+500]
+                r = self._conn.execute('SELECT * FROM objects WHERE path IN ({})'.format(','.join('?'*len(x))), x)
+                for path, size, md5, generation, updated in r:
+                    objects[path] = {'path':path, 'size':size, 'md5':md5, 'generation':generation,
+                                     'updated':datetime.strptime(updated[:19], '%Y-%m-%dT%H:%M:%S')}
+        if other:
+            backend = get_storage_backend()
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                for p,o in zip(other, executor.map(backend.stat, other)):
+                    if o is not None:
+                        objects[p] = o
+        return objects
+
+    def iter_objects(self, prefix='', batch_size=10000):
+        """Iterate over indexed objects under prefix"""
+        gs_prefix = self._prefix(prefix)
+        start = gs_prefix
+        op = '>='
+        while True:  # read in batches, keyed on the last path
+            with self._lock:
+                rows = self._conn.execute('SELECT * FROM objects WHERE path{}? AND path<? ORDER BY path LIMIT ?'.format(op),
+                    (start, gs_prefix+'\U0010ffff', batch_size)).fetchall()
+            for path, size, md5, generation, updated in rows:
+                yield {'path':path, 'size':size, 'md5':md5, 'generation':generation,
+                       'updated':datetime.strptime(updated[:19], '%Y-%m-%dT%H:%M:%S')}
+            if len(rows)<batch_size:
+                break
+            start = rows[-1][0]
+            op = '>'
+
+    def to_dataframe(self, prefix=''):
+        """Indexed objects under prefix as a DataFrame"""
+        gs_prefix = self._prefix(prefix)
+        with self._lock:
+            df = pd.read_sql_query('SELECT * FROM objects WHERE path>=? AND path<? ORDER BY path', self._conn,
+                params=(gs_prefix, gs_prefix+'\U0010ffff'), index_col='path')
+        df['updated'] = pd.to_datetime(df['updated'])
+        return df
+
+    def total_size(self, prefix=''):
+        """Total size (bytes) of indexed objects under prefix"""
+        gs_prefix = self._prefix(prefix)
+        with self._lock:
+            r = self._conn.execute('SELECT SUM(size) FROM objects WHERE path>=? AND path<?',
+                (gs_prefix, gs_prefix+'\U0010ffff')).fetchone()[0]
+        return r if r is not None else 0
+
+    def close(self):
+        self._conn.close()
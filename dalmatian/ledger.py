@@ -0,0 +1,187 @@
+from __future__ import print_function
+import os
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from .core import convert_times, get_price_table
+from .wmanager import _parse_metadata_times, _get_task_stats
+
+# Persistent (SQLite) ledger of workflow costs
+
+
+TERMINAL_STATUSES = ['Succeeded', 'Failed', 'Aborted']
+ROLLUP_KEYS = {
+    'configuration': 'w.configuration',
+    'submission_id': 'w.submission_id',
+    'entity_type': 'w.entity_type',
+    'entity_id': 'w.entity_id',
+    'status': 'w.status',
+    'workflow_name': 'w.workflow_name',
+    'task': 't.task',
+    'machine_type': 't.machine_type',
+    'date': "date(w.end, 'unixepoch')",
+    'month': "strftime('%Y-%m', w.end, 'unixepoch')",
+}
+
+
+class CostLedger(object):
+    """
+    Per-task cost records of the terminal workflows of a workspace, keyed by workflow_id
+
+    Each workflow is ingested once by update(); submissions whose workflows have
+    all been ingested are not queried again. Workflows that could not be ingested
+    (e.g., metadata not available) are recorded in get_errors() and retried by
+    the next update().
+
+    wm:      WorkspaceManager
+    db_path: SQLite file (default: ~/.dalmatian/ledger/{namespace}/{workspace}.sqlite)
+    """
+    def __init__(self, wm, db_path=None):
+        self.wm = wm
+        if db_path is None:
+            db_path = os.path.join(os.path.expanduser('~'), '.dalmatian', 'ledger', wm.namespace, wm.workspace+'.sqlite')
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS workflows ('
+            'workflow_id TEXT PRIMARY KEY, submission_id TEXT, configuration TEXT, entity_type TEXT, entity_id TEXT, '
+            'status TEXT, workflow_name TEXT, start REAL, end REAL, time_h REAL, ingested REAL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS tasks ('
+            'workflow_id TEXT, task TEXT, time_h REAL, total_time_h REAL, max_preempt_time_h REAL, machine_type TEXT, '
+            'attempts INTEGER, cached INTEGER, cpu_hours REAL, est_cost REAL, PRIMARY KEY (workflow_id, task))')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS submissions (submission_id TEXT PRIMARY KEY, ingested REAL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS errors (workflow_id TEXT PRIMARY KEY, submission_id TEXT, error TEXT, time REAL)')
+        self._conn.commit()
+
+    def _ingested(self, table, column):
+        with self._lock:
+            return {i[0] for i in self._conn.execute('SELECT {} FROM {}'.format(column, table))}
+
+    def _get_rows(self, submission, w, metadata):
+        """Workflow and task rows for one workflow"""
+        _parse_metadata_times([metadata])
+        start, end = convert_times([metadata.get('start'), metadata.get('end')])
+        workflow_row = (w['workflowId'], submission['submissionId'], submission['methodConfigurationName'],
+            w['workflowEntity']['entityType'], w['workflowEntity']['entityName'], w['status'],
+            metadata.get('workflowName'), start, end, (end-start)/3600, time.time())
+        task_rows = []
+        for t,calls in metadata.get('calls', {}).items():
+            if not calls:
+                continue
+            s = _get_task_stats(calls)
+            vcpus = get_price_table().vcpus([s.get('machine_type')])[0]
+            task_rows.append((w['workflowId'], t.rsplit('.')[-1], s['time_h'], s['total_time_h'],
+                s.get('max_preempt_time_h'), s.get('machine_type'), s.get('attempts'), int(s['cached']),
+                s['total_time_h']*(1 if np.isnan(vcpus) else vcpus), s.get('est_cost', 0)))
+        return workflow_row, task_rows
+
+    def update(self, config=None, num_threads=10):
+        """Ingest terminal workflows (of submissions matching config) that are not in the ledger yet"""
+        done = self._ingested('submissions', 'submission_id')
+        ingested = self._ingested('workflows', 'workflow_id')
+        submissions = [s for s in self.wm.list_submissions(config=config) if s['submissionId'] not in done]
+
+        # find new terminal workflows
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            details = list(executor.map(lambda s: self.wm.get_submission(s['submissionId']), submissions))
+        jobs = []
+        finished = []
+        for s,r in zip(submissions, details):
+            workflows = [w for w in r['workflows'] if 'workflowId' in w]
+            jobs.extend([(s,w) for w in workflows if w['status'] in TERMINAL_STATUSES and w['workflowId'] not in ingested])
+            if r['status'] in ['Done', 'Aborted'] and all(w['status'] in TERMINAL_STATUSES for w in r['workflows']):
+                finished.append(s['submissionId'])
+
+        def _ingest(job):
+            s,w = job
+            try:
+                return self._get_rows(s, w, self.wm.get_workflow_metadata(s['submissionId'], w['workflowId'])), None
+            except Exception as e:
+                return None, '{}: {}'.format(type(e).__name__, e)
+
+        n = 0
+        failed = set()
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for k,((s,w),(rows,error)) in enumerate(zip(jobs, executor.map(_ingest, jobs)), 1):
+                with self._lock:
+                    if error is None:
+                        self._conn.execute('INSERT OR REPLACE INTO workflows VALUES (?,?,?,?,?,?,?,?,?,?,?)', rows[0])
+                        self._conn.executemany('INSERT OR REPLACE INTO tasks VALUES (?,?,?,?,?,?,?,?,?,?)', rows[1])
+                        self._conn.execute('DELETE FROM errors WHERE workflow_id=?', (w['workflowId'],))
+                        n += 1
+                    else:
+                        self._conn.execute('INSERT OR REPLACE INTO errors VALUES (?,?,?,?)',
+                            (w['workflowId'], s['submissionId'], error, time.time()))
+                        failed.add(s['submissionId'])
+                    if k%100==0:
+                        self._conn.commit()
+                print('\r  * ingested {}/{} workflows'.format(n, len(jobs)), end='')
+        with self._lock:
+            # submissions with workflows that failed to ingest are revisited by the next update
+            self._conn.executemany('INSERT OR REPLACE INTO submissions VALUES (?,?)',
+                [(i, time.time()) for i in finished if i not in failed])
+            self._conn.commit()
+        print('\r  * ingested {} workflows from {} submissions'.format(n, len(submissions)))
+        errors = len(jobs)-n
+        if errors>0:
+            print('  * {} workflows could not be ingested (see get_errors())'.format(errors))
+        return n
+
+    def get_workflows(self):
+        """Ingested workflows with their total cost"""
+        with self._lock:
+            df = pd.read_sql_query('SELECT w.*, SUM(t.est_cost) AS est_cost, SUM(t.cpu_hours) AS cpu_hours '
+                'FROM workflows w LEFT JOIN tasks t USING(workflow_id) GROUP BY w.workflow_id', self._conn, index_col='workflow_id')
+        return df
+
+    def get_errors(self):
+        """Workflows that could not be ingested"""
+        with self._lock:
+            return pd.read_sql_query('SELECT * FROM errors', self._conn, index_col='workflow_id')
+
+    def get_tasks(self):
+        """Ingested per-task records"""
+        with self._lock:
+            return pd.read_sql_query('SELECT * FROM tasks', self._conn)
+
+    def rollup(self, by='configuration', start=None, end=None):
+        """
+        Aggregate cost, CPU hours and number of workflows
+
+        by: one or more of configuration, submission_id, entity_type, entity_id,
+            status, workflow_name, task, machine_type, date, month
+        start, end: restrict to workflows that ended in [start, end) (epoch or date string)
+        """
+        if isinstance(by, str):
+            by = [by]
+        for k in by:
+            if k not in ROLLUP_KEYS:
+                raise ValueError('Unsupported rollup key: {}'.format(k))
+        where = []
+        params = []
+        for op,t in [('>=', start), ('<', end)]:
+            if t is not None:
+                where.append('w.end{}?'.format(op))
+                params.append(t if isinstance(t, (int, float)) else pd.Timestamp(t, tz='UTC').timestamp())
+        query = ('SELECT {keys}, COUNT(DISTINCT w.workflow_id) AS workflows, SUM(t.est_cost) AS est_cost, '
+                 'SUM(t.cpu_hours) AS cpu_hours, SUM(t.total_time_h) AS total_time_h '
+                 'FROM tasks t JOIN workflows w USING(workflow_id) {where} GROUP BY {groups} ORDER BY est_cost DESC').format(
+            keys=', '.join('{} AS {}'.format(ROLLUP_KEYS[k], k) for k in by),
+            where='WHERE '+' AND '.join(where) if where else '',
+            groups=', '.join(ROLLUP_KEYS[k] for k in by))
+        with self._lock:
+            df = pd.read_sql_query(query, self._conn, params=params)
+        return df.set_index(by)
+
+    def total_cost(self):
+        with self._lock:
+            r = self._conn.execute('SELECT SUM(est_cost) FROM tasks').fetchone()[0]
+        return r if r is not None else 0
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,135 @@
+from __future__ import print_function
+import os
+import re
+import json
+import threading
+import warnings
+import numpy as np
+import pandas as pd
+
+# VM and disk pricing (used by get_vm_cost, get_stats, calculate_google_cost)
+
+
+DEFAULT_PRICE_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'vm_prices.json')
+HOURS_PER_MONTH = 730
+
+_CUSTOM_PATTERN = re.compile(r'^(?:(n1|n2|e2)-)?custom-(\d+)-(\d+)(-ext)?$')
+_PREDEFINED_PATTERN = re.compile(r'^(n1|n2|e2)-(standard|highmem|highcpu)-(\d+)$')
+
+
+class PriceTable(object):
+    """
+    Versioned price table, loaded from a JSON file (default: dalmatian/data/vm_prices.json)
+
+    Machine types listed in the table are priced directly; other predefined
+    and custom types (custom-N-M, n2-custom-N-M, ...) are priced from
+    their vCPU and memory components.
+    """
+    def __init__(self, path=None):
+        self.path = path if path is not None else DEFAULT_PRICE_TABLE
+        with open(self.path) as f:
+            self.table = json.load(f)
+        self.version = self.table['version']
+        self._cache = {}
+
+    def decode(self, machine_type):
+        """Decode machine type into family, vCPUs and memory (GB)"""
+        machine_type = machine_type.rsplit('/', 1)[-1]
+        if machine_type in self.table['shared_core']:
+            d = self.table['shared_core'][machine_type]
+            return {'family':machine_type.split('-')[0], 'custom':False, 'extended':False,
+                    'vcpus':d['vcpus'], 'memory_gb':d['memory_gb']}
+        m = _CUSTOM_PATTERN.match(machine_type)
+        if m:
+            return {'family':m.group(1) or 'n1', 'custom':True, 'extended':m.group(4) is not None,
+                    'vcpus':int(m.group(2)), 'memory_gb':int(m.group(3))/1024}
+        m = _PREDEFINED_PATTERN.match(machine_type)
+        if m:
+            vcpus = int(m.group(3))
+            return {'family':m.group(1), 'custom':False, 'extended':False,
+                    'vcpus':vcpus, 'memory_gb':vcpus*self.table['memory_per_vcpu'][m.group(1)][m.group(2)]}
+        raise ValueError('Unknown machine type: {}'.format(machine_type))
+
+    def hourly_price(self, machine_type, preemptible=True):
+        """Price per hour of a machine type"""
+        key = (machine_type, bool(preemptible))
+        if key not in self._cache:
+            tier = 'preemptible' if preemptible else 'standard'
+            name = machine_type.rsplit('/', 1)[-1]
+            if name in self.table['machine_types'][tier]:
+                price = self.table['machine_types'][tier][name]
+            else:
+                d = self.decode(name)
+                family = d['family']+'-custom' if d['custom'] else d['family']
+                if family not in self.table['components'] or (d['extended'] and family+'-extended' not in self.table['components']):
+                    raise ValueError('Unsupported machine type (no prices in table {}): {}'.format(self.version, name))
+                c = self.table['components'][family][tier]
+                if d['extended']:  # memory above the per-vCPU maximum is billed as extended memory
+                    base_gb = min(d['memory_gb'], d['vcpus']*self.table['memory_per_vcpu'][d['family']]['highmem'])
+                    e = self.table['components'][family+'-extended'][tier]
+                    price = d['vcpus']*c['vcpu'] + base_gb*c['memory_gb'] + (d['memory_gb']-base_gb)*e['memory_gb']
+                else:
+                    price = d['vcpus']*c['vcpu'] + d['memory_gb']*c['memory_gb']
+            self._cache[key] = price
+        return self._cache[key]
+
+    def disk_price(self, disk_type='pd-standard', preemptible=True):
+        """Price per GB-month of a disk type"""
+        return self.table['disks'][disk_type]['preemptible' if preemptible else 'standard']
+
+    def vcpus(self, machine_types):
+        """Number of vCPUs for each machine type (array; NaN for missing and unknown values)"""
+        codes, uniques = pd.factorize(pd.Series(list(machine_types), dtype=object))
+        v = np.full(len(uniques)+1, np.nan)
+        for k,m in enumerate(uniques):
+            try:
+                v[k] = self.decode(m)['vcpus']
+            except ValueError as e:
+                warnings.warn(str(e))
+        return v[codes]  # code -1 (missing) maps to NaN
+
+    def price(self, machine_types, preemptible=True, hours=1, disk_gb=None, disk_type='pd-standard'):
+        """
+        Cost of running machine types for hours (arrays or scalars; NaN for missing machine
+        types, and, with a warning, for machine types that cannot be priced from the table)
+
+        disk_gb: include the cost of disk_gb of disk_type
+        """
+        mt_codes, mt_uniques = pd.factorize(pd.Series(list(np.atleast_1d(machine_types)), dtype=object))
+        preemptible = np.broadcast_to(np.asarray(preemptible, dtype=bool), mt_codes.shape)
+        # price each (machine type, preemptible) pair once
+        codes = np.where(mt_codes>=0, mt_codes*2 + preemptible, -1)
+        prices = np.full(2*len(mt_uniques)+1, np.nan)
+        for c in np.unique(codes[codes>=0]):
+            try:
+                prices[c] = self.hourly_price(mt_uniques[c//2], preemptible=bool(c%2))
+            except ValueError as e:
+                warnings.warn(str(e))
+        hourly = prices[codes]
+        if disk_gb is not None:
+            disk_prices = np.where(preemptible, self.disk_price(disk_type, True), self.disk_price(disk_type, False))
+            hourly = hourly + np.asarray(disk_gb, dtype=float)*disk_prices/HOURS_PER_MONTH
+        return hourly*np.asarray(hours, dtype=float)
+
+
+_PRICE_TABLE = None
+_PRICE_TABLE_LOCK = threading.Lock()
+
+
+def get_price_table():
+    """Get the price table used for cost estimates (default: bundled table)"""
+    global _PRICE_TABLE
+    if _PRICE_TABLE is None:
+        with _PRICE_TABLE_LOCK:
+            if _PRICE_TABLE is None:
+                _PRICE_TABLE = PriceTable()
+    return _PRICE_TABLE
+
+
+def set_price_table(table):
+    """Set the price table used for cost estimates (PriceTable or path to JSON file)"""
+    global _PRICE_TABLE
+    if not isinstance(table, PriceTable):
+        table = PriceTable(table)
+    _PRICE_TABLE = table
+    return table
@@ -0,0 +1,294 @@
+from __future__ import print_function
+import threading
+import time
+import random
+from datetime import datetime, timedelta
+import requests
+from requests.adapters import HTTPAdapter
+import google.auth
+from google.auth.transport.requests import Request
+from google.oauth2 import id_token
+import firecloud.api
+
+# Shared HTTP session for all FireCloud/rawls/GCS calls made by dalmatian
+
+
+SCOPES = [
+    'https://www.googleapis.com/auth/userinfo.profile',
+    'https://www.googleapis.com/auth/userinfo.email',
+    'https://www.googleapis.com/auth/devstorage.full_control',
+    'https://www.googleapis.com/auth/genomics',
+]
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter (rate: requests/s, capacity: maximum burst)"""
+    def __init__(self, rate=20, capacity=40):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now-self.timestamp)*self.rate)
+                self.timestamp = now
+                if self.tokens>=1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens)/self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter(object):
+    """
+    AIMD concurrency limiter: the number of concurrent requests grows by
+    ~1 per limit successful requests, and is multiplied by decrease
+    when the server signals overload (429/5xx)
+    """
+    def __init__(self, initial=10, min_limit=1, max_limit=100, decrease=0.5):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.inflight>=int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+
+    def release(self, overloaded=False):
+        with self._cond:
+            self.inflight -= 1
+            if overloaded:
+                self.limit = max(self.min_limit, self.limit*self.decrease)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1/self.limit)
+            self._cond.notify_all()
+
+
+class RequestPolicy(object):
+    """
+    Rate limiting and retry policy applied to all requests of a session
+
+    rate, burst:     token bucket parameters (requests/s)
+    concurrency:     initial concurrency limit (adapted between min/max_concurrency)
+    max_retries:     maximum number of retries per call
+    backoff, max_backoff: exponential backoff with full jitter (seconds)
+    deadline:        maximum time (seconds) spent on a call, including retries
+    retry_methods:   methods retried on 5xx/connection errors (429 is always retried)
+    """
+    retry_codes = (429, 500, 502, 503, 504)
+
+    def __init__(self, rate=20, burst=40, concurrency=10, min_concurrency=1, max_concurrency=100,
+                 max_retries=6, backoff=1, max_backoff=60, deadline=900,
+                 retry_methods=('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')):
+        self.bucket = TokenBucket(rate=rate, capacity=burst)
+        self.limiter = AdaptiveLimiter(initial=concurrency, min_limit=min_concurrency, max_limit=max_concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.retry_methods = set(retry_methods)
+
+    def should_retry(self, method, status_code):
+        return status_code==429 or (status_code in self.retry_codes and method.upper() in self.retry_methods)
+
+    def get_backoff(self, attempt, response=None):
+        """Full-jitter exponential backoff; honors Retry-After if provided"""
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                return min(float(response.headers['Retry-After']), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff*2**attempt))
+
+
+class DalmatianSession(requests.Session):
+    """
+    Thread-safe, pooled HTTP session with cached access tokens
+
+    pool_size: maximum number of keep-alive connections per host
+    timeout:   default (connect, read) timeout in seconds, applied to
+               requests that don't specify one
+    refresh_margin: refresh the access token this many seconds before expiry
+    policy:    RequestPolicy (rate limiting, adaptive concurrency, retries)
+    """
+    def __init__(self, credentials=None, pool_size=50, timeout=(10, 300), refresh_margin=300, policy=None):
+        super(DalmatianSession, self).__init__()
+        self._credentials = credentials
+        self._lock = threading.Lock()
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.policy = policy if policy is not None else RequestPolicy()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        # session used for token refresh (avoids recursion through request())
+        self._refresh_request = Request(session=requests.Session())
+
+    @property
+    def credentials(self):
+        """Google credentials (resolved on first use)"""
+        if self._credentials is None:
+            with self._lock:
+                if self._credentials is None:
+                    self._credentials = google.auth.default(SCOPES)[0]
+        return self._credentials
+
+    def _token_expired(self):
+        c = self.credentials
+        if c.token is None or c.expiry is None:
+            return c.token is None
+        return datetime.utcnow() + timedelta(seconds=self.refresh_margin) >= c.expiry
+
+    def get_token(self):
+        """Return a valid access token, refreshing it only when close to expiry"""
+        if self._token_expired():
+            with self._lock:
+                if self._token_expired():
+                    self.credentials.refresh(self._refresh_request)
+        return self.credentials.token
+
+    def _send(self, method, url, headers, timeout, **kwargs):
+        """Single request under the rate and concurrency limits"""
+        self.policy.bucket.acquire()
+        self.policy.limiter.acquire()
+        overloaded = False
+        try:
+            headers['Authorization'] = 'Bearer {}'.format(self.get_token())
+            r = super(DalmatianSession, self).request(method, url, headers=headers, timeout=timeout, **kwargs)
+            if r.status_code==401:  # token revoked or expired early
+                with self._lock:
+                    self.credentials.refresh(self._refresh_request)
+                headers['Authorization'] = 'Bearer {}'.format(self.credentials.token)
+                r = super(DalmatianSession, self).request(method, url, headers=headers, timeout=timeout, **kwargs)
+            overloaded = r.status_code==429 or r.status_code>=500
+            return r
+        except requests.exceptions.ConnectionError:
+            overloaded = True
+            raise
+        finally:
+            self.policy.limiter.release(overloaded=overloaded)
+
+    def request(self, method, url, headers=None, timeout=None, deadline=None, **kwargs):
+        """
+        Send a request, retrying throttled (429) and failed (5xx, connection
+        error) calls with backoff until max_retries or the deadline is reached
+        """
+        headers = dict(headers) if headers is not None else {}
+        if timeout is None:
+            timeout = self.timeout
+        if deadline is None:
+            deadline = self.policy.deadline
+        end_time = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            r = None
+            try:
+                r = self._send(method, url, headers, timeout, **kwargs)
+                if not self.policy.should_retry(method, r.status_code):
+                    return r
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if method.upper() not in self.policy.retry_methods or attempt>=self.policy.max_retries:
+                    raise
+            if attempt>=self.policy.max_retries:
+                return r
+            wait = self.policy.get_backoff(attempt, response=r)
+            if time.monotonic()+wait>end_time:
+                if r is not None:
+                    return r
+                raise requests.exceptions.Timeout('Deadline of {}s exceeded for {} {}'.format(deadline, method, url))
+            time.sleep(wait)
+            attempt += 1
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _get_user_id(session):
+    """Email of the authenticated user (as set by firecloud.api for whoami())"""
+    session.get_token()
+    credentials = session.credentials
+    if getattr(credentials, 'id_token', None) is not None:
+        try:
+            return id_token.verify_oauth2_token(credentials.id_token, session._refresh_request, clock_skew_in_seconds=10)['email']
+        except TypeError:  # older google-auth
+            return id_token.verify_oauth2_token(credentials.id_token, session._refresh_request)['email']
+    return getattr(credentials, 'service_account_email', None)
+
+
+def _whoami():
+    """firecloud.api.whoami() for the dalmatian session (user ID resolved on first call)"""
+    if getattr(firecloud.api, '__USER_ID') is None:
+        setattr(firecloud.api, '__USER_ID', _get_user_id(getattr(firecloud.api, '__SESSION')))
+    return getattr(firecloud.api, '__USER_ID')
+
+
+def _install_session(session):
+    """Route all firecloud.api calls through session"""
+    setattr(firecloud.api, '__SESSION', session)
+    setattr(firecloud.api, '__USER_ID', None)
+    firecloud.api.whoami = _whoami
+
+
+def get_session():
+    """
+    Get the session shared by all WorkspaceManagers and repository calls
+    (installed as the firecloud.api session on first use)
+    """
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = DalmatianSession()
+                _install_session(_SESSION)
+    return _SESSION
+
+
+def configure_session(credentials=None, pool_size=50, timeout=(10, 300), refresh_margin=300, policy=None):
+    """Replace the shared session (e.g., to change pool size, timeouts or request policy)"""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = DalmatianSession(credentials=credentials, pool_size=pool_size,
+            timeout=timeout, refresh_margin=refresh_margin, policy=policy)
+        _install_session(_SESSION)
+    return _SESSION
+
+
+# Google Cloud APIs (Cloud Storage, Genomics) support much higher request rates
+# than FireCloud; their calls use a separate session and policy
+_CLOUD_SESSION = None
+
+
+def get_cloud_session():
+    """Get the session used for Cloud Storage and Genomics API calls"""
+    global _CLOUD_SESSION
+    if _CLOUD_SESSION is None:
+        with _SESSION_LOCK:
+            if _CLOUD_SESSION is None:
+                _CLOUD_SESSION = DalmatianSession(pool_size=200,
+                    policy=RequestPolicy(rate=1000, burst=1000, concurrency=50, max_concurrency=500))
+    return _CLOUD_SESSION
+
+
+def configure_cloud_session(credentials=None, pool_size=200, timeout=(10, 300), refresh_margin=300, policy=None):
+    """Replace the session used for Cloud Storage and Genomics API calls"""
+    global _CLOUD_SESSION
+    if policy is None:
+        policy = RequestPolicy(rate=1000, burst=1000, concurrency=50, max_concurrency=500)
+    with _SESSION_LOCK:
+        if _CLOUD_SESSION is not None:
+            _CLOUD_SESSION.close()
+        _CLOUD_SESSION = DalmatianSession(credentials=credentials, pool_size=pool_size,
+            timeout=timeout, refresh_margin=refresh_margin, policy=policy)
+    return _CLOUD_SESSION
@@ -0,0 +1,323 @@
+from __future__ import print_function
+import os
+import shutil
+import hashlib
+import binascii, base64
+import threading
+from datetime import datetime
+from urllib.parse import quote
+from .session import get_cloud_session
+
+# Storage backends used by the bucket helpers (gs_list_bucket_files, gs_copy, ...)
+
+
+def split_gs_path(path):
+    """Split gs://bucket/object into (bucket, object)"""
+    assert path.startswith('gs://'), 'Path must start with gs://'
+    bucket, _, name = path[5:].partition('/')
+    return bucket, name
+
+
+def b64_to_hex(md5):
+    """Convert base64-encoded hash (GCS metadata) to hex"""
+    return binascii.hexlify(base64.b64decode(md5)).decode()
+
+
+class StorageBackend(object):
+    """
+    Interface for object storage
+
+    Objects are described by dicts with keys
+      path (gs://bucket/object), size (bytes), md5 (hex, None if not available),
+      generation, updated (datetime)
+    """
+    def list(self, prefix, delimiter=None):
+        """Iterate over objects starting with prefix (gs://bucket/prefix)"""
+        raise NotImplementedError
+
+    def list_prefixes(self, prefix, delimiter='/'):
+        """List 'directories' directly under prefix"""
+        raise NotImplementedError
+
+    def stat(self, path):
+        """Object metadata, or None if the object does not exist"""
+        raise NotImplementedError
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def read(self, path, start=None, end=None):
+        """Read object content (bytes); start/end select a byte range, end inclusive. Negative start reads the tail."""
+        raise NotImplementedError
+
+    def iter_read(self, path, chunk_size=16*1024**2):
+        """Iterate over object content in chunks"""
+        raise NotImplementedError
+
+    def delete(self, path):
+        raise NotImplementedError
+
+    def copy(self, source_path, dest_path):
+        """Copy object within storage"""
+        raise NotImplementedError
+
+    def upload(self, local_path, dest_path):
+        raise NotImplementedError
+
+    def download(self, source_path, local_path):
+        raise NotImplementedError
+
+    def move(self, source_path, dest_path):
+        self.copy(source_path, dest_path)
+        self.delete(source_path)
+
+
+class GCSBackend(StorageBackend):
+    """
+    In-process Google Cloud Storage backend using the JSON API
+
+    Requests go through the shared Cloud Storage session (pooled connections,
+    cached tokens, rate limiting and retries; see configure_cloud_session).
+    """
+    api_url = 'https://storage.googleapis.com/storage/v1/'
+    upload_url = 'https://storage.googleapis.com/upload/storage/v1/'
+    fields = 'name,bucket,size,md5Hash,generation,updated'
+
+    def __init__(self, session=None, upload_chunk_size=64*1024**2):
+        self._session = session
+        self.upload_chunk_size = upload_chunk_size
+
+    @property
+    def session(self):
+        return self._session if self._session is not None else get_cloud_session()
+
+    def _object_url(self, path):
+        bucket, name = split_gs_path(path)
+        return '{}b/{}/o/{}'.format(self.api_url, bucket, quote(name, safe=''))
+
+    def _parse(self, item):
+        return {
+            'path': 'gs://{}/{}'.format(item['bucket'], item['name']),
+            'size': int(item['size']),
+            'md5': b64_to_hex(item['md5Hash']) if 'md5Hash' in item else None,
+            'generation': int(item['generation']),
+            'updated': datetime.strptime(item['updated'][:19], '%Y-%m-%dT%H:%M:%S'),
+        }
+
+    def _list_pages(self, prefix, delimiter=None):
+        bucket, name = split_gs_path(prefix)
+        params = {'prefix': name, 'maxResults': 1000,
+                  'fields': 'items({}),prefixes,nextPageToken'.format(self.fields)}
+        if delimiter is not None:
+            params['delimiter'] = delimiter
+        while True:
+            r = self.session.get('{}b/{}/o'.format(self.api_url, bucket), params=params)
+            if r.status_code!=200:
+                raise ValueError('Listing {} failed: {}'.format(prefix, r.text))
+            r = r.json()
+            yield r
+            if 'nextPageToken' not in r:
+                break
+            params['pageToken'] = r['nextPageToken']
+
+    def list(self, prefix, delimiter=None):
+        for page in self._list_pages(prefix, delimiter=delimiter):
+            for item in page.get('items', []):
+                yield self._parse(item)
+
+    def list_prefixes(self, prefix, delimiter='/'):
+        bucket, _ = split_gs_path(prefix)
+        for page in self._list_pages(prefix, delimiter=delimiter):
+            for p in page.get('prefixes', []):
+                yield 'gs://{}/{}'.format(bucket, p)
+
+    def stat(self, path):
+        r = self.session.get(self._object_url(path), params={'fields': self.fields})
+        if r.status_code==404:
+            return None
+        elif r.status_code!=200:
+            raise ValueError('Stat failed for {}: {}'.format(path, r.text))
+        return self._parse(r.json())
+
+    def read(self, path, start=None, end=None):
+        headers = {}
+        if start is not None and start<0:
+            headers['Range'] = 'bytes={}'.format(start)
+        elif start is not None or end is not None:
+            headers['Range'] = 'bytes={}-{}'.format(start or 0, '' if end is None else end)
+        r = self.session.get(self._object_url(path), params={'alt': 'media'}, headers=headers)
+        if r.status_code==416:  # range not satisfiable (empty object)
+            return b''
+        elif r.status_code not in [200, 206]:
+            raise ValueError('Read failed for {}: {}'.format(path, r.text))
+        return r.content
+
+    def iter_read(self, path, chunk_size=16*1024**2):
+        r = self.session.get(self._object_url(path), params={'alt': 'media'}, stream=True)
+        if r.status_code!=200:
+            raise ValueError('Read failed for {}: {}'.format(path, r.text))
+        try:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                yield chunk
+        finally:
+            r.close()
+
+    def delete(self, path):
+        r = self.session.delete(self._object_url(path))
+        if r.status_code not in [204, 200]:
+            raise ValueError('Delete failed for {}: {}'.format(path, r.text))
+
+    def copy(self, source_path, dest_path):
+        dest_bucket, dest_name = split_gs_path(dest_path)
+        url = '{}/rewriteTo/b/{}/o/{}'.format(self._object_url(source_path), dest_bucket, quote(dest_name, safe=''))
+        params = {}
+        while True:  # large objects may require multiple rewrite calls
+            r = self.session.post(url, params=params)
+            if r.status_code!=200:
+                raise ValueError('Copy failed for {}: {}'.format(source_path, r.text))
+            r = r.json()
+            if r['done']:
+                return
+            params['rewriteToken'] = r['rewriteToken']
+
+    def upload(self, local_path, dest_path):
+        bucket, name = split_gs_path(dest_path)
+        size = os.path.getsize(local_path)
+        url = '{}b/{}/o'.format(self.upload_url, bucket)
+        if size<=self.upload_chunk_size:
+            with open(local_path, 'rb') as f:
+                r = self.session.post(url, params={'uploadType': 'media', 'name': name}, data=f.read())
+            if r.status_code!=200:
+                raise ValueError('Upload failed for {}: {}'.format(local_path, r.text))
+            return
+        # resumable upload in chunks
+        r = self.session.post(url, params={'uploadType': 'resumable', 'name': name},
+            headers={'X-Upload-Content-Length': str(size)})
+        if r.status_code!=200:
+            raise ValueError('Upload failed for {}: {}'.format(local_path, r.text))
+        session_url = r.headers['Location']
+        with open(local_path, 'rb') as f:
+            offset = 0
+            while offset<size:
+                f.seek(offset)
+                chunk = f.read(self.upload_chunk_size)
+                r = self.session.put(session_url, data=chunk, headers={
+                    'Content-Range': 'bytes {}-{}/{}'.format(offset, offset+len(chunk)-1, size)})
+                if r.status_code in [200, 201]:
+                    return
+                elif r.status_code==308:  # resume from last persisted byte
+                    offset = int(r.headers['Range'].split('-')[-1])+1 if 'Range' in r.headers else 0
+                else:
+                    raise ValueError('Upload failed for {}: {}'.format(local_path, r.text))
+
+    def download(self, source_path, local_path):
+        with open(local_path, 'wb') as f:
+            for chunk in self.iter_read(source_path):
+                f.write(chunk)
+
+
+class LocalBackend(StorageBackend):
+    """
+    Local-filesystem backend (e.g., for tests): gs://bucket/object is stored
+    as {root}/bucket/object
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def _local_path(self, path):
+        bucket, name = split_gs_path(path)
+        return os.path.join(self.root, bucket, name)
+
+    def _stat(self, local_path):
+        st = os.stat(local_path)
+        h = hashlib.md5()
+        with open(local_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(16*1024**2), b''):
+                h.update(chunk)
+        return {
+            'path': 'gs://'+os.path.relpath(local_path, self.root).replace(os.sep, '/'),
+            'size': st.st_size,
+            'md5': h.hexdigest(),
+            'generation': int(st.st_mtime*1e6),
+            'updated': datetime.utcfromtimestamp(st.st_mtime),
+        }
+
+    def list(self, prefix, delimiter=None):
+        bucket, name = split_gs_path(prefix)
+        bucket_dir = os.path.join(self.root, bucket)
+        paths = []
+        for dirpath, _, filenames in os.walk(bucket_dir):
+            for f in filenames:
+                p = os.path.relpath(os.path.join(dirpath, f), bucket_dir).replace(os.sep, '/')
+                if p.startswith(name) and (delimiter is None or delimiter not in p[len(name):]):
+                    paths.append(p)
+        for p in sorted(paths):
+            yield self._stat(os.path.join(bucket_dir, p))
+
+    def list_prefixes(self, prefix, delimiter='/'):
+        bucket, name = split_gs_path(prefix)
+        prefixes = set()
+        for o in self.list(prefix):
+            rest = split_gs_path(o['path'])[1][len(name):]
+            if delimiter in rest:
+                prefixes.add('gs://{}/{}{}'.format(bucket, name, rest.split(delimiter)[0]+delimiter))
+        return iter(sorted(prefixes))
+
+    def stat(self, path):
+        p = self._local_path(path)
+        if not os.path.isfile(p):
+            return None
+        return self._stat(p)
+
+    def read(self, path, start=None, end=None):
+        with open(self._local_path(path), 'rb') as f:
+            if start is not None and start<0:
+                f.seek(max(os.path.getsize(self._local_path(path))+start, 0))
+                return f.read()
+            f.seek(start or 0)
+            if end is None:
+                return f.read()
+            return f.read(end-(start or 0)+1)
+
+    def iter_read(self, path, chunk_size=16*1024**2):
+        with open(self._local_path(path), 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+    def delete(self, path):
+        os.remove(self._local_path(path))
+
+    def _put(self, local_path, dest_path):
+        d = self._local_path(dest_path)
+        os.makedirs(os.path.dirname(d), exist_ok=True)
+        shutil.copyfile(local_path, d)
+
+    def copy(self, source_path, dest_path):
+        self._put(self._local_path(source_path), dest_path)
+
+    def upload(self, local_path, dest_path):
+        self._put(local_path, dest_path)
+
+    def download(self, source_path, local_path):
+        shutil.copyfile(self._local_path(source_path), local_path)
+
+
+_BACKEND = None
+_BACKEND_LOCK = threading.Lock()
+
+
+def get_storage_backend():
+    """Get the storage backend used by the bucket helpers (default: GCSBackend)"""
+    global _BACKEND
+    if _BACKEND is None:
+        with _BACKEND_LOCK:
+            if _BACKEND is None:
+                _BACKEND = GCSBackend()
+    return _BACKEND
+
+
+def set_storage_backend(backend):
+    """Set the storage backend used by the bucket helpers"""
+    global _BACKEND
+    assert isinstance(backend, StorageBackend)
+    _BACKEND = backend
@@ -4,13 +4,14 @@ import numpy as np
 import subprocess
 import os
 import io
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import firecloud.api
 from firecloud import fiss
-import iso8601
-import pytz
 from datetime import datetime
 from .core import *
+from .inventory import BucketInventory
 
 
 def is_member(a, b):
@@ -21,9 +22,227 @@ def is_member(a, b):
             bind[elt] = i
     return [bind.get(itm, np.nan) for itm in a]
 
+
+def _plan_list_removal(list_s, ids):
+    """
+    For a Series of lists (e.g., sample set memberships), find the entries
+    containing any of ids. Returns DataFrame with 'removed' and 'remaining' lists.
+    """
+    list_s = list_s[list_s.apply(lambda x: isinstance(x, list) and len(x)>0)]
+    if len(list_s)==0:
+        return pd.DataFrame(columns=['removed', 'remaining'])
+    members = list_s.explode()
+    hit = members.isin(ids)
+    affected = hit.groupby(level=0).any()
+    affected = affected[affected].index
+    members = members[members.index.isin(affected)]
+    hit = hit[hit.index.isin(affected)]
+    df = pd.DataFrame(index=affected)
+    df['removed'] = members[hit].groupby(level=0).apply(list).reindex(affected)
+    df['remaining'] = members[~hit].groupby(level=0).apply(list).reindex(affected)
+    df['remaining'] = df['remaining'].apply(lambda x: x if isinstance(x, list) else [])
+    return df
+
+
+def _get_entity_status(etype, submissions, submission_dict):
+    """
+    Latest workflow status for each entity
+
+    submissions: output from list_submissions
+    submission_dict: {submission_id: output from get_submission}
+    """
+    entity_dict = {}
+    timestamps = convert_times([s['submissionDate'] for s in submissions])
+    for s,ts in zip(submissions, timestamps):
+        if s['submissionId'] not in submission_dict:
+            continue
+        r = submission_dict[s['submissionId']]
+        for w in r['workflows']:
+            entity_id = w['workflowEntity']['entityName']
+            if entity_id not in entity_dict or entity_dict[entity_id]['timestamp']<ts:
+                entity_dict[entity_id] = {
+                    'status':w['status'],
+                    'timestamp':ts,
+                    'submission_id':s['submissionId'],
+                    'configuration':s['methodConfigurationName']
+                }
+                if 'workflowId' in w:
+                    entity_dict[entity_id]['workflow_id'] = w['workflowId']
+                else:
+                    entity_dict[entity_id]['workflow_id'] = 'NA'
+    status_df = pd.DataFrame(entity_dict).T
+    status_df.index.name = etype+'_id'
+
+    return status_df[['status', 'timestamp', 'workflow_id', 'submission_id', 'configuration']]
+
+
+def _collect_gs_paths(x, paths):
+    """Add all gs:// paths found in x (nested lists/dicts) to the set paths"""
+    if isinstance(x, str):
+        if x.startswith('gs://'):
+            paths.add(x)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _collect_gs_paths(v, paths)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _collect_gs_paths(v, paths)
+
+
+def _map_values(df, func):
+    """Apply func to each element of df (DataFrame.applymap for pandas<2.1)"""
+    return df.map(func) if hasattr(pd.DataFrame, 'map') else df.applymap(func)
+
+
+def _entities_to_df(etype, all_entities):
+    """Convert entity query results to DataFrame"""
+    df = pd.DataFrame({i['name']:i['attributes'] for i in all_entities}).T
+    df.index.name = etype+'_id'
+    # convert JSON to lists; assumes that values are stored in 'items'
+    df = _map_values(df, lambda x: x['items'] if isinstance(x, dict) and 'items' in x else x)
+    return df
+
+
+def _parse_metadata_times(metadata_list):
+    """Parse all timestamps in workflow metadata in bulk (subsequent conversions are cache lookups)"""
+    timestamps = []
+    for m in metadata_list:
+        timestamps.extend([m.get('start'), m.get('end')])
+        for attempts in m.get('calls', {}).values():
+            for j in attempts:
+                timestamps.extend([j.get('start'), j.get('end')])
+                timestamps.extend([e.get(k) for e in j.get('executionEvents', []) for k in ['startTime', 'endTime']])
+    convert_times(timestamps)
+
+
+def _get_attempts_cost(machine_types, preemptible, hours):
+    """Cost of a list of attempts (attempts without a machine type are free; NaN if a machine type cannot be priced)"""
+    if np.any(np.isnan(get_vm_costs(machine_types, preemptible=preemptible)) & pd.notnull(machine_types)):
+        return np.nan
+    return np.nansum(get_vm_costs(machine_types, preemptible=preemptible, hours=hours))
+
+
+def _get_task_stats(calls):
+    """
+    Time, preemptions, cost, etc. for one task of a workflow
+
+    calls: list of attempts/shards of the task (workflow metadata['calls'][task])
+    """
+    successes = {}
+    preemptions = []
+    if 'shardIndex' in calls[0]:
+        for j in calls:
+            if j['shardIndex'] in successes:
+                preemptions.append(j)
+            # last shard (assume success follows preemptions)
+            successes[j['shardIndex']] = j
+    else:
+        successes[0] = calls[-1]
+        preemptions = calls[:-1]
+
+    # subtract time spent waiting for quota
+    quota_time = [e for m in successes.values() for e in m.get('executionEvents', []) if e['description']=='waiting for quota']
+    quota_time = np.sum((convert_times([q['endTime'] for q in quota_time]) - convert_times([q['startTime'] for q in quota_time]))/3600)
+    total_time_h = workflow_times(calls)/3600
+    stats = {
+        'time_h': np.sum(workflow_times(list(successes.values()))/3600) - quota_time,
+        'total_time_h': np.sum(total_time_h) - quota_time,
+        'cached': bool(np.any([j.get('callCaching', {}).get('hit', False) for j in calls])),
+    }
+    if not stats['cached']:
+        was_preemptible = [j.get('preemptible', False) for j in calls]
+        if len(preemptions)>0:
+            stats['max_preempt_time_h'] = np.max(workflow_times(preemptions))/3600
+        stats['attempts'] = len(calls)
+        stats['start_time'] = convert_time(calls[0]['start'])
+        machine_types = [j['jes']['machineType'].rsplit('/')[-1] if 'machineType' in j.get('jes', {}) else None for j in calls]
+        stats['machine_type'] = machine_types[-1]  # use last instance
+        stats['est_cost'] = _get_attempts_cost(machine_types, was_preemptible, total_time_h)
+        stats['job_ids'] = ','.join([j['jobId'] for j in successes.values() if 'jobId' in j])
+    return stats
+
+
+def _get_stats(status_df, metadata_dict, timezone):
+    """
+    Calculate time, preemptions, cost, etc. from workflow metadata
+
+    status_df: successful workflows (output from get_entity_status)
+    metadata_dict: {entity_id: workflow metadata}
+    """
+    _parse_metadata_times(metadata_dict.values())
+
+    # if workflow_name is None:
+        # split output by workflow
+    workflows = np.array([metadata_dict[k]['workflowName'] for k in metadata_dict])
+    # else:
+        # workflows = np.array([workflow_name])
+
+    columns = ['time_h', 'total_time_h', 'max_preempt_time_h', 'machine_type', 'attempts', 'start_time', 'est_cost', 'job_ids']
+    # get tasks for each workflow
+    for w in np.unique(workflows):
+        workflow_status_df = status_df[workflows==w]
+        tasks = np.sort(list(metadata_dict[workflow_status_df.index[0]]['calls'].keys()))
+
+        task_dfs = {}
+        for t in tasks:
+            task_name = t.rsplit('.')[-1]
+            task_dfs[task_name] = pd.DataFrame.from_dict({i:_get_task_stats(metadata_dict[i]['calls'][t])
+                for i in workflow_status_df.index}, orient='index', dtype=object).reindex(workflow_status_df.index, columns=columns)
+            task_dfs[task_name]['start_time'] = format_times(task_dfs[task_name]['start_time'], '%H:%M', timezone=timezone)
+
+        # add overall cost
+        workflow_status_df['est_cost'] = pd.concat([task_dfs[t.rsplit('.')[-1]]['est_cost'] for t in tasks], axis=1).sum(axis=1)
+        workflow_status_df['time_h'] = workflow_times([metadata_dict[i] for i in workflow_status_df.index])/3600
+        # vCPUs decoded from machine types (tasks without machine type, e.g. call-cached, count as 1)
+        workflow_status_df['cpu_hours'] = pd.concat([task_dfs[t.rsplit('.')[-1]]['total_time_h'].astype(float) * np.nan_to_num(get_price_table().vcpus(task_dfs[t.rsplit('.')[-1]]['machine_type']), nan=1) for t in tasks], axis=1).sum(axis=1)
+        workflow_status_df['start_time'] = format_times(convert_times([metadata_dict[i]['start'] for i in workflow_status_df.index]), '%H:%M', timezone=timezone)
+
+    return workflow_status_df, task_dfs
+
+
+def _flatten_hashes(x, prefix=''):
+    """Flatten nested call-caching hashes into {'input/File bam': hash, ...}"""
+    flat = {}
+    for k,v in x.items():
+        if isinstance(v, dict):
+            flat.update(_flatten_hashes(v, prefix+k+'/'))
+        else:
+            flat[prefix+k] = v
+    return flat
+
+
+def _get_callcache_records(metadata):
+    """Call-caching outcome, compute hours and cost for each task shard of a workflow"""
+    records = []
+    for t,calls in metadata.get('calls', {}).items():
+        shards = defaultdict(list)
+        for j in calls:
+            if 'subWorkflowMetadata' not in j:
+                shards[j.get('shardIndex', -1)].append(j)
+        for shard,attempts in shards.items():
+            cc = attempts[-1].get('callCaching', {})
+            machine_types = [j['jes']['machineType'].rsplit('/')[-1] if 'machineType' in j.get('jes', {}) else None for j in attempts]
+            time_h = np.nan_to_num(workflow_times(attempts)/3600)
+            vcpus = np.nan_to_num(get_price_table().vcpus(machine_types), nan=1)
+            records.append({
+                'task': t.rsplit('.')[-1],
+                'shard': shard,
+                'enabled': bool(cc) and cc.get('effectiveCallCachingMode', 'ReadAndWriteCache') in ['ReadAndWriteCache', 'ReadCache'],
+                'hit': bool(cc.get('hit', False)),
+                'result': cc.get('result'),
+                'cpu_hours': np.sum(time_h*vcpus),
+                'est_cost': _get_attempts_cost(machine_types, [j.get('preemptible', False) for j in attempts], time_h),
+                'hashes': _flatten_hashes(cc['hashes']) if 'hashes' in cc else None,
+            })
+    return records
+
+
 #------------------------------------------------------------------------------
 #  Extension of firecloud.api functionality using the rawls (internal) API
 #------------------------------------------------------------------------------
+RAWLS_API_URL = 'https://rawls.dsde-prod.broadinstitute.org/api/'
+
+
 def _batch_update_entities(namespace, workspace, json_body):
     """ Batch update entity attributes in a workspace.
 
@@ -71,17 +290,18 @@ def _batch_update_entities(namespace, workspace, json_body):
     """
     headers = firecloud.api._fiss_agent_header({"Content-type":  "application/json"})
     uri = "{0}workspaces/{1}/{2}/entities/batchUpdate".format(
-        'https://rawls.dsde-prod.broadinstitute.org/api/', namespace, workspace)
+        RAWLS_API_URL, namespace, workspace)
 
-    return firecloud.api.__post(uri, headers=headers, json=json_body)
+    return get_session().post(uri, headers=headers, json=json_body)
 
 
 #------------------------------------------------------------------------------
 #  Top-level classes representing workspace(s)
 #------------------------------------------------------------------------------
 class WorkspaceCollection(object):
-    def __init__(self):
+    def __init__(self, num_threads=10):
         self.workspace_list = []
+        self.num_threads = num_threads
 
     def add(self, workspace_manager):
         assert isinstance(workspace_manager, WorkspaceManager)
@@ -95,17 +315,81 @@ class WorkspaceCollection(object):
         for i in self.workspace_list:
             print('  {}/{}'.format(i.namespace, i.workspace))
 
-    def get_submission_status(self, show_namespaces=False):
-        """Get status of all submissions across workspaces"""
+    def _workspace_name(self, wm, show_namespaces=False):
+        if show_namespaces:
+            return '{}/{}'.format(wm.namespace, wm.workspace)
+        else:
+            return wm.workspace
+
+    def _map(self, func):
+        """
+        Apply func(workspace_manager) to all workspaces concurrently.
+        Returns a list of (workspace_manager, result, error) tuples.
+        """
+        def _apply(wm):
+            try:
+                return wm, func(wm), None
+            except Exception as e:
+                return wm, None, '{}: {}'.format(type(e).__name__, e)
+
+        with ThreadPoolExecutor(max_workers=max(min(self.num_threads, len(self.workspace_list)), 1)) as executor:
+            return list(executor.map(_apply, self.workspace_list))
+
+    def _concat(self, func, show_namespaces=False):
+        """
+        Concatenate DataFrames returned by func(workspace_manager) across workspaces.
+        Failing workspaces are reported as rows with the 'error' column set.
+        """
         dfs = []
-        for i in self.workspace_list:
-            df = i.get_submission_status(show_namespaces=show_namespaces)
-            if show_namespaces:
-                df['workspace'] = '{}/{}'.format(i.namespace, i.workspace)
-            else:
-                df['workspace'] = i.workspace
+        for wm, df, error in self._map(func):
+            if error is not None:
+                df = pd.DataFrame({'error':[error]})
+            df['workspace'] = self._workspace_name(wm, show_namespaces=show_namespaces)
             dfs.append(df)
-        return pd.concat(dfs, axis=0)
+        return pd.concat(dfs, axis=0, sort=False)
+
+    def get_submission_status(self, show_namespaces=False, **kwargs):
+        """Get status of all submissions across workspaces"""
+        return self._concat(lambda wm: wm.get_submission_status(show_namespaces=show_namespaces, **kwargs),
+            show_namespaces=show_namespaces)
+
+    def get_entities(self, etype, show_namespaces=False, **kwargs):
+        """Get entities and their attributes across workspaces"""
+        return self._concat(lambda wm: wm.get_entities(etype, **kwargs), show_namespaces=show_namespaces)
+
+    def get_samples(self, show_namespaces=False):
+        """Get samples and their attributes across workspaces"""
+        return self._concat(lambda wm: wm.get_samples(), show_namespaces=show_namespaces)
+
+    def get_sample_sets(self, show_namespaces=False):
+        """Get sample sets and their attributes across workspaces"""
+        return self._concat(lambda wm: wm.get_sample_sets(), show_namespaces=show_namespaces)
+
+    def get_participants(self, show_namespaces=False):
+        """Get participants and their attributes across workspaces"""
+        return self._concat(lambda wm: wm.get_participants(), show_namespaces=show_namespaces)
+
+    def get_pairs(self, show_namespaces=False):
+        """Get pairs and their attributes across workspaces"""
+        return self._concat(lambda wm: wm.get_pairs(), show_namespaces=show_namespaces)
+
+    def get_entity_status(self, etype, config, show_namespaces=False):
+        """Get status of latest submission for the entity type across workspaces"""
+        return self._concat(lambda wm: wm.get_entity_status(etype, config), show_namespaces=show_namespaces)
+
+    def get_storage(self, show_namespaces=False):
+        """Get total amount of storage used (in TB) by each workspace"""
+        df = pd.DataFrame([{
+                'workspace':self._workspace_name(wm, show_namespaces=show_namespaces),
+                'storage_tb':storage if error is None else np.nan,
+                'error':error,
+            } for wm, storage, error in self._map(lambda wm: wm.get_storage())])
+        return df.set_index('workspace')
+
+    def get_stats(self, etype, config, show_namespaces=False):
+        """Get runtime and cost statistics for the latest runs of a configuration across workspaces"""
+        return self._concat(lambda wm: wm.get_stats(wm.get_entity_status(etype, config))[0],
+            show_namespaces=show_namespaces)
 
 
 class WorkspaceManager(object):
@@ -156,6 +440,11 @@ class WorkspaceManager(object):
         return bucket_id
 
 
+    def get_inventory(self, db_path=None):
+        """Get the local inventory index of the workspace bucket (see BucketInventory)"""
+        return BucketInventory(self.get_bucket_id(), db_path=db_path)
+
+
     def upload_entities(self, etype, df, index=True):
         """
         index: True if DataFrame index corresponds to ID
@@ -230,6 +519,47 @@ class WorkspaceManager(object):
             self.update_participant_entities('sample')
 
 
+    def sync_samples(self, df, dest_dir, file_columns=None, checksum=True, num_threads=10):
+        """
+        Upload local files referenced in df to dest_dir (only missing or
+        changed files), then register the gs:// paths as sample attributes
+
+        df: DataFrame indexed by sample_id; if it contains participant[_id],
+            samples are created/updated with upload_samples, otherwise the
+            file attributes of existing samples are updated
+        file_columns: columns containing local paths (default: all columns
+            whose values are existing local files)
+
+        Returns the gs_sync table (one row per file).
+        """
+        if file_columns is None:
+            file_columns = [c for c in df.columns
+                if df[c].apply(lambda x: isinstance(x, str) and not x.startswith('gs://') and os.path.isfile(x)).all()]
+        file_columns = list(file_columns)
+        assert len(file_columns)>0, 'No columns with local file paths found.'
+
+        source_s = df[file_columns].stack()
+        dest_s = source_s.apply(lambda x: os.path.join(dest_dir, os.path.basename(x)))
+        assert not dest_s.duplicated().any(), 'Destination file names must be unique.'
+        sync_df = gs_sync(source_s.tolist(), dest_s.tolist(), checksum=checksum, num_threads=num_threads)
+        sync_df.index = source_s.index
+        sync_df.index.names = [df.index.name, 'attribute']
+
+        # only register samples for which all files were synced
+        failed = sync_df.index[sync_df['action']=='failed'].get_level_values(0).unique()
+        if len(failed)>0:
+            print('Files for {} samples failed to upload; these samples are not registered.'.format(len(failed)))
+        gs_df = df.drop(failed).copy()
+        gs_df[file_columns] = dest_s.drop(failed, level=0).unstack()[file_columns]
+        if gs_df.shape[0]>0:
+            if 'participant' in gs_df.columns or 'participant_id' in gs_df.columns:
+                gs_df.index.name = 'sample_id'
+                self.upload_samples(gs_df)
+            else:
+                self.update_entity_attributes('sample', gs_df[file_columns])
+        return sync_df
+
+
     def update_participant_entities(self, etype):
         """Attach entities (samples or pairs) to participants"""
 
@@ -364,13 +694,14 @@ class WorkspaceManager(object):
         submissions = self.list_submissions(config=config)
 
         statuses = ['Succeeded', 'Running', 'Failed', 'Aborted', 'Aborting', 'Submitted', 'Queued']
+        dates = format_times(convert_times([s['submissionDate'] for s in submissions]), '%H:%M:%S %m/%d/%Y')
         df = []
-        for s in submissions:
+        for s,date in zip(submissions, dates):
             d = {
                 'entity_id':s['submissionEntity']['entityName'],
                 'status':s['status'],
                 'submission_id':s['submissionId'],
-                'date':iso8601.parse_date(s['submissionDate']).strftime('%H:%M:%S %m/%d/%Y'),
+                'date':date,
             }
             d.update({i:s['workflowStatuses'].get(i,0) for i in statuses})
             if show_namespaces:
@@ -439,7 +770,7 @@ class WorkspaceManager(object):
         submissions = self.list_submissions(config=config)
 
         # get status of last run submission
-        entity_dict = {}
+        submission_dict = {}
         for k,s in enumerate(submissions, 1):
             print('\rFetching submission {}/{}'.format(k, len(submissions)), end='')
             if s['submissionEntity']['entityType']!=etype:
@@ -447,26 +778,9 @@ class WorkspaceManager(object):
                     s['submissionEntity']['entityType']))
                 print('\rSkipping : '+ s['submissionId'])
                 continue
-            r = self.get_submission(s['submissionId'])
-            ts = datetime.timestamp(iso8601.parse_date(s['submissionDate']))
-            for w in r['workflows']:
-                entity_id = w['workflowEntity']['entityName']
-                if entity_id not in entity_dict or entity_dict[entity_id]['timestamp']<ts:
-                    entity_dict[entity_id] = {
-                        'status':w['status'],
-                        'timestamp':ts,
-                        'submission_id':s['submissionId'],
-                        'configuration':s['methodConfigurationName']
-                    }
-                    if 'workflowId' in w:
-                        entity_dict[entity_id]['workflow_id'] = w['workflowId']
-                    else:
-                        entity_dict[entity_id]['workflow_id'] = 'NA'
+            submission_dict[s['submissionId']] = self.get_submission(s['submissionId'])
         print()
-        status_df = pd.DataFrame(entity_dict).T
-        status_df.index.name = etype+'_id'
-
-        return status_df[['status', 'timestamp', 'workflow_id', 'submission_id', 'configuration']]
+        return _get_entity_status(etype, submissions, submission_dict)
 
 
     def get_sample_status(self, configuration):
@@ -605,20 +919,55 @@ class WorkspaceManager(object):
         return state_df, summary_df
 
 
-    def get_stderr(self, state_df, task_name):
+    def get_stderr(self, state_df, task_name, tail_bytes=None, num_threads=20):
         """
-        Fetch stderrs from bucket (returns list of str)
+        Fetch stderrs from bucket (returns pd.Series of str, indexed by entity ID and shard)
+
+        For each shard (shard -1 for unscattered tasks), the latest attempt is used;
+        if any shards failed, only the failed shards are returned.
+
+        tail_bytes: only fetch the last tail_bytes of each log (ranged read)
         """
-        df = state_df[state_df[task_name]==-1]
-        fail_idx = df.index
-        stderrs = []
-        for n,i in enumerate(fail_idx, 1):
-            print('\rFetching stderr for task {}/{}'.format(n, len(fail_idx)), end='\r')
+        df = state_df[state_df[task_name].isin([-1, 'Failed'])]
+        backend = get_storage_backend()
+
+        def _get_paths(i):
             metadata = self.get_workflow_metadata(state_df.loc[i, 'submission_id'], state_df.loc[i, 'workflow_id'])
-            stderr_path = metadata['calls'][[i for i in metadata['calls'].keys() if i.split('.')[1]==task_name][0]][-1]['stderr']
-            s = subprocess.check_output('gsutil cat '+stderr_path, shell=True).decode()
-            stderrs.append(s)
-        return stderrs
+            calls = metadata['calls'][[k for k in metadata['calls'].keys() if k.split('.')[1]==task_name][0]]
+            latest = {}  # shard -> latest attempt
+            for c in calls:
+                shard = c.get('shardIndex', -1)
+                if shard not in latest or c.get('attempt', 1)>=latest[shard].get('attempt', 1):
+                    latest[shard] = c
+            failed = {k:c for k,c in latest.items() if c.get('executionStatus')=='Failed'}
+            return [((i, k), c['stderr']) for k,c in sorted((failed or latest).items()) if 'stderr' in c]
+
+        def _fetch(path):
+            if tail_bytes is None:
+                return backend.read(path).decode(errors='replace')
+            else:
+                return backend.read(path, start=-tail_bytes).decode(errors='replace')
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            paths = [p for r in executor.map(_get_paths, df.index) for p in r]
+            stderrs = []
+            for n,s in enumerate(executor.map(_fetch, [p for _,p in paths]), 1):
+                print('\rFetching stderr {}/{}'.format(n, len(paths)), end='\r')
+                stderrs.append(s)
+        return pd.Series(stderrs, index=pd.MultiIndex.from_tuples([k for k,_ in paths],
+            names=[df.index.name, 'shard']), dtype=object)
+
+
+    def get_stderr_clusters(self, state_df, task_name, tail_bytes=8192, num_threads=20, max_examples=5):
+        """
+        Cluster failures of a task by normalized error signature
+        (from the tail of each stderr log)
+
+        Returns a DataFrame with the count and example (entity ID, shard) for each signature
+        """
+        stderr_s = self.get_stderr(state_df, task_name, tail_bytes=tail_bytes, num_threads=num_threads)
+        print()
+        return cluster_errors(stderr_s, max_examples=max_examples)
 
 
     def get_submission_history(self, sample_id, config=None):
@@ -635,129 +984,207 @@ class WorkspaceManager(object):
             and 'Succeeded' in list(s['workflowStatuses'].keys())
         ]
 
+        timestamps = convert_times([s['submissionDate'] for s in submissions])
+        dates = format_times(timestamps, '%H:%M:%S %m/%d/%Y')
         outputs_df = []
-        for s in submissions:
+        for s,date in zip(submissions, dates):
             r = self.get_submission(s['submissionId'])
 
             metadata = self.get_workflow_metadata(s['submissionId'], r['workflows'][0]['workflowId'])
 
             outputs_s = pd.Series(metadata['outputs'])
             outputs_s.index = [i.split('.',1)[1].replace('.','_') for i in outputs_s.index]
-            outputs_s['submission_date'] = iso8601.parse_date(s['submissionDate']).strftime('%H:%M:%S %m/%d/%Y')
+            outputs_s['submission_date'] = date
             outputs_df.append(outputs_s)
 
         outputs_df = pd.concat(outputs_df, axis=1).T
         # sort by most recent first
-        outputs_df = outputs_df.iloc[np.argsort([datetime.timestamp(iso8601.parse_date(s['submissionDate'])) for s in submissions])[::-1]]
+        outputs_df = outputs_df.iloc[np.argsort(timestamps)[::-1]]
         outputs_df.index = ['run_{}'.format(str(i)) for i in np.arange(outputs_df.shape[0],0,-1)]
 
         return outputs_df
 
 
-    def get_storage(self):
+    def get_storage(self, num_threads=10, inventory=None):
         """
         Get total amount of storage used, in TB
 
+        inventory: BucketInventory to answer from instead of listing the bucket
+
         Pricing: $0.026/GB/month (multi-regional)
                  $0.02/GB/month (regional)
         """
+        if inventory is not None:
+            return np.float64(inventory.total_size())/1024**4
         bucket_id = self.get_bucket_id()
-        s = subprocess.check_output('gsutil du -s gs://'+bucket_id, shell=True)
-        return np.float64(s.decode().split()[0])/1024**4
+        total_bytes = sum(i['size'] for i in gs_iter_bucket_files(bucket_id, num_threads=num_threads))
+        return np.float64(total_bytes)/1024**4
 
 
-    def get_stats(self, status_df, workflow_name=None):
-        """
-        For a list of submissions, calculate time, preemptions, etc
+    def get_storage_report(self, num_threads=10, by_entity=False, inventory=None, max_age=3600,
+                           price_per_gb_month=0.026):
         """
-        # for successful jobs, get metadata and count attempts
-        status_df = status_df[status_df['status']=='Succeeded'].copy()
-        metadata_dict = {}
-        for k,(i,row) in enumerate(status_df.iterrows(), 1):
-            print('\rFetching metadata {}/{}'.format(k,status_df.shape[0]), end='')
-            fetch = True
-            while fetch:  # improperly dealing with 500s here...
-                try:
-                    metadata = self.get_workflow_metadata(row['submission_id'], row['workflow_id'])
-                    metadata_dict[i] = metadata.json()
-                    fetch = False
-                except:
-                    pass
-
-        # if workflow_name is None:
-            # split output by workflow
-        workflows = np.array([metadata_dict[k]['workflowName'] for k in metadata_dict])
-        # else:
-            # workflows = np.array([workflow_name])
-
-        # get tasks for each workflow
-        for w in np.unique(workflows):
-            workflow_status_df = status_df[workflows==w]
-            tasks = np.sort(list(metadata_dict[workflow_status_df.index[0]]['calls'].keys()))
-            task_names = [t.rsplit('.')[-1] for t in tasks]
-
-            task_dfs = {}
-            for t in tasks:
-                task_name = t.rsplit('.')[-1]
-                task_dfs[task_name] = pd.DataFrame(index=workflow_status_df.index,
-                    columns=[
-                        'time_h',
-                        'total_time_h',
-                        'max_preempt_time_h',
-                        'machine_type',
-                        'attempts',
-                        'start_time',
-                        'est_cost',
-                        'job_ids'])
-                for i in workflow_status_df.index:
-                    successes = {}
-                    preemptions = []
-
-                    if 'shardIndex' in metadata_dict[i]['calls'][t][0]:
-                        scatter = True
-                        for j in metadata_dict[i]['calls'][t]:
-                            if j['shardIndex'] in successes:
-                                preemptions.append(j)
-                            # last shard (assume success follows preemptions)
-                            successes[j['shardIndex']] = j
-                    else:
-                        scatter = False
-                        successes[0] = metadata_dict[i]['calls'][t][-1]
-                        preemptions = metadata_dict[i]['calls'][t][:-1]
+        Storage used by top-level prefix, submission/workflow output trees,
+        and configuration (via the submissions in the workspace)
 
-                    task_dfs[task_name].loc[i, 'time_h'] = np.sum([workflow_time(j)/3600 for j in successes.values()])
+        Top-level prefixes are sized concurrently (or read from inventory).
+        Results are cached on the WorkspaceManager for max_age seconds.
 
-                    # subtract time spent waiting for quota
-                    quota_time = [e for m in successes.values() for e in m['executionEvents'] if e['description']=='waiting for quota']
-                    quota_time = [(convert_time(q['endTime']) - convert_time(q['startTime']))/3600 for q in quota_time]
-                    task_dfs[task_name].loc[i, 'time_h'] -= np.sum(quota_time)
+        by_entity: attribute workflow outputs to entities (one get_submission call per submission)
 
-                    total_time_h = [workflow_time(t_attempt)/3600 for t_attempt in metadata_dict[i]['calls'][t]]
-                    task_dfs[task_name].loc[i, 'total_time_h'] = np.sum(total_time_h) - np.sum(quota_time)
+        Returns DataFrames (prefix_df, config_df, workflow_df) with size_bytes,
+        files, and monthly_cost columns.
 
-                    if not np.any(['hit' in j['callCaching'] and j['callCaching']['hit'] for j in metadata_dict[i]['calls'][t]]):
-                        was_preemptible = [j['preemptible'] for j in metadata_dict[i]['calls'][t]]
-                        if len(preemptions)>0:
-                            assert was_preemptible[0]
-                            task_dfs[task_name].loc[i, 'max_preempt_time_h'] = np.max([workflow_time(t_attempt) for t_attempt in preemptions])/3600
-                        task_dfs[task_name].loc[i, 'attempts'] = len(metadata_dict[i]['calls'][t])
-
-                        task_dfs[task_name].loc[i, 'start_time'] = iso8601.parse_date(metadata_dict[i]['calls'][t][0]['start']).astimezone(pytz.timezone(self.timezone)).strftime('%H:%M')
+        Pricing: $0.026/GB/month (multi-regional)
+                 $0.02/GB/month (regional)
+        """
+        key = (by_entity, inventory is not None)
+        cache = getattr(self, '_storage_report_cache', {})
+        if key in cache and time.time()-cache[key][0]<=max_age:
+            workflow_df = cache[key][1]
+        else:
+            bucket_id = self.get_bucket_id()
+            root = 'gs://{}/'.format(bucket_id)
+
+            def _aggregate(objects):
+                sizes = defaultdict(lambda: [0, 0])
+                for i in objects:
+                    k = tuple((i['path'][len(root):].split('/')[:-1] + ['', '', ''])[:3])
+                    sizes[k][0] += i['size']
+                    sizes[k][1] += 1
+                return sizes
+
+            if inventory is not None:
+                sizes = _aggregate(inventory.iter_objects())
+            else:
+                backend = get_storage_backend()
+                prefixes = list(backend.list_prefixes(root))
+                sizes = _aggregate(backend.list(root, delimiter='/'))
+                with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                    for k,r in enumerate(executor.map(lambda x: _aggregate(backend.list(x)), prefixes), 1):
+                        print('\rSizing prefix {}/{}'.format(k, len(prefixes)), end='')
+                        for i,j in r.items():
+                            sizes[i][0] += j[0]
+                            sizes[i][1] += j[1]
+                print()
 
-                        machine_types = [j['jes']['machineType'].rsplit('/')[-1] for j in metadata_dict[i]['calls'][t]]
-                        task_dfs[task_name].loc[i, 'machine_type'] = machine_types[-1]  # use last instance
+            workflow_df = pd.DataFrame([list(k)+v for k,v in sizes.items()],
+                columns=['prefix', 'workflow', 'workflow_id', 'size_bytes', 'files'])
+
+            # attribute submission directories to configurations
+            submissions = {s['submissionId']:s for s in self.list_submissions()}
+            workflow_df['configuration'] = workflow_df['prefix'].apply(
+                lambda x: submissions[x]['methodConfigurationName'] if x in submissions else np.nan)
+            if by_entity:
+                ids = [i for i in workflow_df['prefix'].unique() if i in submissions]
+                with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                    r = list(executor.map(self.get_submission, ids))
+                entity_dict = {w['workflowId']:w['workflowEntity']['entityName']
+                    for i in r for w in i['workflows'] if 'workflowId' in w}
+                workflow_df['entity'] = workflow_df['workflow_id'].map(entity_dict)
+            cache[key] = (time.time(), workflow_df)
+            self._storage_report_cache = cache
+
+        workflow_df = workflow_df.copy()
+        workflow_df['monthly_cost'] = workflow_df['size_bytes']/1024**3 * price_per_gb_month
+        prefix_df = workflow_df.groupby('prefix')[['size_bytes', 'files', 'monthly_cost']].sum()
+        config_df = workflow_df.fillna({'configuration':'(unassigned)'}).groupby('configuration')[['size_bytes', 'files', 'monthly_cost']].sum()
+        return (prefix_df.sort_values('size_bytes', ascending=False),
+                config_df.sort_values('size_bytes', ascending=False),
+                workflow_df.sort_values('size_bytes', ascending=False))
+
+
+    def get_callcache_report(self, config, num_threads=10, max_examples=5):
+        """
+        Call-caching effectiveness for the workflows of a configuration
 
-                        task_dfs[task_name].loc[i, 'est_cost'] = np.sum([get_vm_cost(m,p)*h for h,m,p in zip(total_time_h, machine_types, was_preemptible)])
+        Returns:
+          task_df:   per-task hit rates, and CPU hours/cost spent on cache misses
+          miss_df:   cache misses for which an earlier run of the same entity/task/shard
+                     was found, with the hashes (e.g., inputs) that changed
+          error_df:  workflows whose metadata could not be fetched (not included in the report)
+        """
+        submissions = self.list_submissions(config=config)
+        submissions = [submissions[k] for k in np.argsort(convert_times([s['submissionDate'] for s in submissions]), kind='stable')]
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            details = list(executor.map(lambda s: self.get_submission(s['submissionId']), submissions))
+        jobs = [(s['submissionId'], w['workflowId'], w['workflowEntity']['entityName'])
+            for s,r in zip(submissions, details) for w in r['workflows']
+            if 'workflowId' in w and w['status'] in ['Succeeded', 'Failed', 'Aborted']]
+
+        def _fetch(job):
+            try:
+                return _get_callcache_records(self.get_workflow_metadata(job[0], job[1])), None
+            except Exception as e:
+                return [], '{}: {}'.format(type(e).__name__, e)
+
+        records = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for k,(job,(r,error)) in enumerate(zip(jobs, executor.map(_fetch, jobs)), 1):
+                print('\rFetching metadata {}/{}'.format(k, len(jobs)), end='')
+                if error is not None:
+                    errors.append({'submission_id':job[0], 'workflow_id':job[1], 'entity_id':job[2], 'error':error})
+                for i in r:
+                    i.update({'submission_id':job[0], 'workflow_id':job[1], 'entity_id':job[2]})
+                records.extend(r)
+        print()
+        error_df = pd.DataFrame(errors, columns=['submission_id', 'workflow_id', 'entity_id', 'error'])
+        if error_df.shape[0]>0:
+            print('Metadata for {} workflows could not be fetched (see error_df).'.format(error_df.shape[0]))
+        df = pd.DataFrame(records, columns=['task', 'shard', 'enabled', 'hit', 'result', 'cpu_hours', 'est_cost',
+                                            'hashes', 'submission_id', 'workflow_id', 'entity_id'])
+
+        # compare hashes of each miss with the latest earlier run of the same entity/task/shard
+        miss_df = []
+        last = {}
+        for r in df.itertuples():  # in submission order
+            key = (r.entity_id, r.task, r.shard)
+            if r.enabled and not r.hit and key in last and r.hashes is not None and last[key].hashes is not None:
+                ref = last[key].hashes
+                changed = sorted([k for k in set(r.hashes)|set(ref) if r.hashes.get(k)!=ref.get(k)])
+                miss_df.append({'task':r.task, 'entity_id':r.entity_id, 'shard':r.shard, 'workflow_id':r.workflow_id,
+                    'reference_workflow_id':last[key].workflow_id, 'cpu_hours':r.cpu_hours, 'changed':changed})
+            if r.hashes is not None or key not in last:
+                last[key] = r
+        miss_df = pd.DataFrame(miss_df, columns=['task', 'entity_id', 'shard', 'workflow_id',
+                                                 'reference_workflow_id', 'cpu_hours', 'changed'])
+
+        df[['enabled', 'hit']] = df[['enabled', 'hit']].astype(bool)
+        enabled_df = df.loc[df['enabled']]
+        misses = enabled_df.loc[~enabled_df['hit']]
+        task_df = pd.DataFrame({
+            'calls': df.groupby('task').size(),
+            'cache_enabled': enabled_df.groupby('task').size(),
+            'hits': enabled_df.groupby('task')['hit'].sum(),
+            'misses': misses.groupby('task').size(),
+            'miss_cpu_hours': misses.groupby('task')['cpu_hours'].sum(),
+            'miss_est_cost': misses.groupby('task')['est_cost'].sum(),
+        }).fillna(0)
+        task_df[['calls', 'cache_enabled', 'hits', 'misses']] = task_df[['calls', 'cache_enabled', 'hits', 'misses']].astype(int)
+        task_df['hit_rate'] = task_df['hits'] / task_df['cache_enabled'].replace(0, np.nan)
+        # most frequently changed hashes among misses
+        changed_s = miss_df.explode('changed').dropna(subset=['changed']).groupby('task')['changed'].apply(
+            lambda x: ', '.join('{} ({})'.format(k,n) for k,n in x.value_counts().iloc[:max_examples].items()))
+        task_df['changed_hashes'] = changed_s.reindex(task_df.index)
+        task_df.index.name = 'task'
+        return task_df.sort_values('miss_cpu_hours', ascending=False), miss_df, error_df
 
-                        task_dfs[task_name].loc[i, 'job_ids'] = ','.join([j['jobId'] for j in successes.values()])
 
-            # add overall cost
-            workflow_status_df['est_cost'] = pd.concat([task_dfs[t.rsplit('.')[-1]]['est_cost'] for t in tasks], axis=1).sum(axis=1)
-            workflow_status_df['time_h'] = [workflow_time(metadata_dict[i])/3600 for i in workflow_status_df.index]
-            workflow_status_df['cpu_hours'] = pd.concat([task_dfs[t.rsplit('.')[-1]]['total_time_h'] * task_dfs[t.rsplit('.')[-1]]['machine_type'].apply(lambda i: int(i.rsplit('-',1)[-1]) if (pd.notnull(i) and '-small' not in i and '-micro' not in i) else 1) for t in tasks], axis=1).sum(axis=1)
-            workflow_status_df['start_time'] = [iso8601.parse_date(metadata_dict[i]['start']).astimezone(pytz.timezone(self.timezone)).strftime('%H:%M') for i in workflow_status_df.index]
+    def get_stats(self, status_df, workflow_name=None):
+        """
+        For a list of submissions, calculate time, preemptions, etc
+        """
+        # for successful jobs, get metadata and count attempts
+        status_df = status_df[status_df['status']=='Succeeded'].copy()
+        metadata_dict = {}
+        for k,(i,row) in enumerate(status_df.iterrows(), 1):
+            print('\rFetching metadata {}/{}'.format(k,status_df.shape[0]), end='')
+            # transient errors are retried by the session's request policy
+            metadata_dict[i] = self.get_workflow_metadata(row['submission_id'], row['workflow_id'])
+        print()
 
-        return workflow_status_df, task_dfs
+        return _get_stats(status_df, metadata_dict, self.timezone)
 
     #-------------------------------------------------------------------------
     #  Methods for manipulating configurations
@@ -912,6 +1339,7 @@ class WorkspaceManager(object):
             return r.json()
         else:
             print(r.text)
+            raise ValueError('Query for {}s failed (page {}).'.format(etype, page))
 
 
     def get_entities(self, etype, page_size=1000):
@@ -927,11 +1355,7 @@ class WorkspaceManager(object):
             all_entities.extend(r['results'])
 
         # convert to DataFrame
-        df = pd.DataFrame({i['name']:i['attributes'] for i in all_entities}).T
-        df.index.name = etype+'_id'
-        # convert JSON to lists; assumes that values are stored in 'items'
-        df = df.applymap(lambda x: x['items'] if isinstance(x, dict) and 'items' in x else x)
-        return df
+        return _entities_to_df(etype, all_entities)
 
 
     def get_samples(self):
@@ -954,8 +1378,8 @@ class WorkspaceManager(object):
         """Get DataFrame with participants and their attributes"""
         df = self.get_entities('participant')
         # convert sample lists from JSON
-        df = df.applymap(lambda x: [i['entityName'] if 'entityName' in i else i for i in x]
-                            if np.all(pd.notnull(x)) and isinstance(x, list) else x)
+        df = _map_values(df, lambda x: [i['entityName'] if 'entityName' in i else i for i in x]
+                             if np.all(pd.notnull(x)) and isinstance(x, list) else x)
         return df
 
 
@@ -963,8 +1387,8 @@ class WorkspaceManager(object):
         """Get DataFrame with sample sets and their attributes"""
         df = self.get_entities('sample_set')
         # convert sample lists from JSON
-        df = df.applymap(lambda x: [i['entityName'] if 'entityName' in i else i for i in x]
-                            if np.all(pd.notnull(x)) and isinstance(x, list) else x)
+        df = _map_values(df, lambda x: [i['entityName'] if 'entityName' in i else i for i in x]
+                             if np.all(pd.notnull(x)) and isinstance(x, list) else x)
         return df
 
 
@@ -972,8 +1396,8 @@ class WorkspaceManager(object):
         """Get DataFrame with sample sets and their attributes"""
         df = self.get_entities('participant_set')
         # convert sample lists from JSON
-        df = df.applymap(lambda x: [i['entityName'] if 'entityName' in i else i for i in x]
-                            if np.all(pd.notnull(x)) and isinstance(x, list) else x)
+        df = _map_values(df, lambda x: [i['entityName'] if 'entityName' in i else i for i in x]
+                             if np.all(pd.notnull(x)) and isinstance(x, list) else x)
         return df
 
 
@@ -1174,51 +1598,117 @@ class WorkspaceManager(object):
             print(r.text)
 
 
-    def delete_sample(self, sample_ids, delete_dependencies=True):
-        """Delete sample or list of samples"""
+    def plan_sample_deletion(self, sample_ids, participant_df=None, set_df=None):
+        """
+        Compute the participant and sample set references that must be removed
+        before the samples can be deleted (single pass over the data model)
+
+        Returns a DataFrame indexed by entity ID with columns
+          entity_type, attribute, removed (list), remaining (list)
+        """
         if isinstance(sample_ids, str):
-            sample_id_set = set([sample_ids])
-        else:
-            sample_id_set = set(sample_ids)
-        etype = 'sample'
-        r = firecloud.api.delete_entity_type(self.namespace, self.workspace, 'sample', sample_ids)
-        if r.status_code==204:
-            print('Sample(s) {} successfully deleted.'.format(sample_ids))
+            sample_ids = [sample_ids]
+        sample_ids = pd.Index(sample_ids).unique()
 
-        elif r.status_code==409 and delete_dependencies:
-            # delete participant dependencies
+        if participant_df is None:
             participant_df = self.get_participants()
-            if 'samples_' in participant_df.columns:
-                participant_df = participant_df[participant_df['samples_'].apply(lambda x: np.any([i in sample_id_set for i in x]))]
-                entitites_dict = participant_df['samples_'].apply(lambda x: np.array([i for i in x if i not in sample_id_set])).to_dict()
-                participant_ids = np.unique(participant_df.index)
-                for n,k in enumerate(participant_ids, 1):
-                    print('\r  * removing {}s for participant {}/{}'.format(etype, n, len(participant_ids)), end='')
-                    attr_dict = {
-                        "{}s_".format(etype): {
-                            "itemsType": "EntityReference",
-                            "items": [{"entityType": etype, "entityName": i} for i in entitites_dict[k]]
-                        }
-                    }
-                    attrs = [firecloud.api._attr_set(i,j) for i,j in attr_dict.items()]
-                    r = firecloud.api.update_entity(self.namespace, self.workspace, 'participant', k, attrs)
-                    assert r.status_code==200
+        if set_df is None:
+            set_df = self.get_sample_sets()
+
+        plan_dfs = []
+        for etype, df, attribute in [('participant', participant_df, 'samples_'),
+                                     ('sample_set', set_df, 'samples')]:
+            if attribute in df.columns:
+                df = _plan_list_removal(df[attribute], sample_ids)
+                df.insert(0, 'attribute', attribute)
+                df.insert(0, 'entity_type', etype)
+                plan_dfs.append(df)
+        if plan_dfs:
+            plan_df = pd.concat(plan_dfs, axis=0)
+        else:
+            plan_df = pd.DataFrame(columns=['entity_type', 'attribute', 'removed', 'remaining'])
+        plan_df.index.name = 'entity_id'
+        return plan_df
+
+
+    def _apply_reference_removals(self, plan_df, member_type='sample', chunk_size=1000):
+        """Write the 'remaining' reference lists from a deletion plan in batched updates"""
+        attr_list = [{
+            'name':i,
+            'entityType':row['entity_type'],
+            'operations':[{
+                'op':'AddUpdateAttribute',
+                'attributeName':row['attribute'],
+                'addUpdateAttribute':{
+                    'itemsType':'EntityReference',
+                    'items':[{'entityType':member_type, 'entityName':j} for j in row['remaining']]
+                }
+            }]
+        } for i,row in plan_df.iterrows()]
+        n = int(np.ceil(len(attr_list)/chunk_size))
+        for k in range(n):
+            print('\r  * removing {} references: batch {}/{}'.format(member_type, k+1, n), end='')
+            r = _batch_update_entities(self.namespace, self.workspace, attr_list[chunk_size*k:chunk_size*(k+1)])
+            if r.status_code!=204:
                 print()
+                print(r.text)
+                raise ValueError('Batch update of {} references failed.'.format(member_type))
+        if n>0:
+            print()
 
-            # delete sample set dependencies
-            set_df = self.get_sample_sets()
-            for i,s in set_df['samples'].items():
-                if np.any([i in sample_id_set for i in s]):
-                    self.update_sample_set(i, np.setdiff1d(s, list(sample_id_set)))
 
+    def delete_sample(self, sample_ids, delete_dependencies=True, dry_run=False, chunk_size=500):
+        """
+        Delete sample or list of samples
+
+        If delete_dependencies is True, references to the samples are removed
+        from participants (samples_) and sample sets in batched updates before
+        the samples are deleted in chunks of chunk_size.
+
+        dry_run: return the deletion plan without modifying the workspace
+        """
+        if isinstance(sample_ids, str):
+            sample_ids = [sample_ids]
+        sample_ids = list(pd.unique(np.asarray(sample_ids)))
+
+        if dry_run:
+            plan_df = self.plan_sample_deletion(sample_ids)
+            print('[dry-run] {} samples will be deleted'.format(len(sample_ids)))
+            for (etype, attribute), g in plan_df.groupby(['entity_type', 'attribute']):
+                print('[dry-run]   * {} references removed from {} {}s ({})'.format(
+                    g['removed'].apply(len).sum(), g.shape[0], etype.replace('_set', ' set'), attribute))
+            return plan_df
+
+        def _delete_chunks(ids):
+            failed = []
+            n = int(np.ceil(len(ids)/chunk_size))
+            for k in range(n):
+                x = ids[chunk_size*k:chunk_size*(k+1)]
+                r = firecloud.api.delete_entity_type(self.namespace, self.workspace, 'sample', x)
+                if r.status_code==204:
+                    print('\r  * deleted chunk {}/{} ({} samples)'.format(k+1, n, len(x)), end='')
+                elif r.status_code==409:
+                    failed.extend(x)
+                else:
+                    print()
+                    print(r.text)
+                    raise ValueError('Sample deletion failed.')
+            if n>0:
+                print()
+            return failed
+
+        failed = _delete_chunks(sample_ids)
+        if failed and delete_dependencies:
+            # remove all participant and sample set references in one pass
+            plan_df = self.plan_sample_deletion(failed)
+            self._apply_reference_removals(plan_df)
             # try again
-            r = firecloud.api.delete_entity_type(self.namespace, self.workspace, 'sample', sample_ids)
-            if r.status_code==204:
-                print('Sample(s) {} successfully deleted.'.format(sample_ids))
-            else:
-                print(r.text)
+            failed = _delete_chunks(failed)
+
+        if failed:
+            print('{} sample(s) could not be deleted due to dependencies.'.format(len(failed)))
         else:
-            print(r.text)
+            print('{} sample(s) successfully deleted.'.format(len(sample_ids)))
 
 
     def delete_sample_set(self, sample_set_id):
@@ -1265,65 +1755,85 @@ class WorkspaceManager(object):
         return sample_set_df[sample_set_df['samples'].apply(lambda x: sample_id in x)].index.tolist()
 
 
-    def purge_unassigned(self, attribute=None, bucket_files=None, entities_df=None, ext=None):
+    def get_referenced_files(self, entities_df=None):
         """
-        Delete any files that don't match attributes in the data model (e.g., from prior/outdated runs)
+        Get the set of gs:// paths referenced in the data model (all entity
+        types, including nested lists, and workspace attributes)
         """
-        if bucket_files is None:
-            bucket_files = gs_list_bucket_files(self.get_bucket_id())
+        referenced = set()
+        if entities_df is not None:
+            _collect_gs_paths(entities_df.values.tolist(), referenced)
+        else:
+            for etype in ['sample', 'sample_set', 'participant', 'participant_set', 'pair', 'pair_set']:
+                r = self._get_entities_query(etype, 1, page_size=1)
+                if r['resultMetadata']['unfilteredCount']>0:
+                    _collect_gs_paths(self.get_entities(etype).values.tolist(), referenced)
+            _collect_gs_paths(list(self.get_attributes().values()), referenced)
+        return referenced
+
 
-        # exclude FireCloud logs etc
-        bucket_files = [i for i in bucket_files if not i.endswith(('exec.sh', 'stderr.log', 'stdout.log'))]
+    def purge_unassigned(self, bucket_files=None, entities_df=None, ext=None, num_threads=10, inventory=None,
+                         exclude=('exec.sh', 'stderr.log', 'stdout.log'), exclude_prefixes=('notebooks/',),
+                         delete=False, manifest_path=None, journal_path=None):
+        """
+        Find (and optionally delete) files that aren't referenced in the data model (e.g., from prior/outdated runs)
+
+        bucket_files: list of paths (default: stream the bucket listing, or use inventory)
+        entities_df:  restrict referenced files to this DataFrame (default: all entities and workspace attributes)
+        ext:          only consider files with this extension
+        exclude:      never consider files ending with these suffixes (FireCloud logs etc)
+        exclude_prefixes: never consider files under these prefixes (relative to the bucket root).
+                      Outputs of active submissions (not Done/Aborted) are always excluded.
+        delete:       delete orphaned files (default: dry run)
+        manifest_path: write the list of orphaned files to this TSV
+        journal_path: journal for resuming an interrupted deletion (see gs_transfer)
+
+        Returns orphaned files (path, size_bytes, submission) and a summary
+        (files and bytes per submission prefix)
+        """
+        referenced = self.get_referenced_files(entities_df=entities_df)
+        print('{} files referenced in the data model.'.format(len(referenced)))
+        exclude = tuple(exclude) if exclude is not None else ()
+        exclude_prefixes = list(exclude_prefixes) if exclude_prefixes is not None else []
+        active = [s['submissionId'] for s in self.list_submissions() if s['status'] not in ['Done', 'Aborted']]
+        if active:
+            print('Excluding outputs of {} active submissions.'.format(len(active)))
+        exclude_prefixes = tuple(exclude_prefixes + ['{}/'.format(i) for i in active])
+
+        if bucket_files is not None:
+            objects = ({'path':i, 'size':np.nan} for i in bucket_files)
+        elif inventory is not None:
+            objects = inventory.iter_objects()
+        else:
+            bucket_id = self.get_bucket_id()
+            objects = gs_iter_bucket_files(bucket_id, num_threads=num_threads)
+
+        orphans = []
+        for k,i in enumerate(objects, 1):
+            if k % 10000==0:
+                print('\r  * scanned {} files ({} orphaned)'.format(k, len(orphans)), end='')
+            p = i['path']
+            if (p in referenced or p.endswith(exclude) or p[5:].split('/', 1)[-1].startswith(exclude_prefixes)
+                    or (ext is not None and not p.endswith(ext))):
+                continue
+            orphans.append((p, i['size']))
+        print()
 
-        if entities_df is None:  # fetch all entities
-            found_attrs = self.get_samples().values.flatten().tolist() \
-                        + self.get_sample_sets().values.flatten().tolist() \
-                        + self.get_participants().values.flatten().tolist()
-            # missing: get_pairs, get_pair_sets --> resolve participant vs participant_id issue first
+        orphan_df = pd.DataFrame(orphans, columns=['path', 'size_bytes'])
+        orphan_df['submission'] = orphan_df['path'].apply(lambda x: x[5:].split('/')[1] if x.count('/')>3 else '')
+        summary_df = orphan_df.groupby('submission').agg(files=('path', 'size'), size_bytes=('size_bytes', 'sum'))
+        summary_df = summary_df.sort_values('size_bytes', ascending=False)
+        print('{} orphaned files ({:.2f} GB) in {} submission prefixes.'.format(
+            orphan_df.shape[0], orphan_df['size_bytes'].sum()/1024**3, summary_df.shape[0]))
+
+        if manifest_path is not None:
+            orphan_df.to_csv(manifest_path, sep='\t', index=False)
+            print('Manifest written to {}'.format(manifest_path))
+        if delete:
+            gs_delete(orphan_df['path'].tolist(), journal_path=journal_path)
         else:
-            found_attrs = entities_df.values.flatten().tolist()
-
-        # flatten
-        assigned = []
-        for i in found_attrs:
-            if isinstance(i, str) and i.startswith('gs://'):
-                assigned.append(i)
-            elif isinstance(i, list) and np.all([j.startswith('gs://') for j in i]):
-                assigned.extend(i)
-
-        # remove assigned from list
-        assigned_set = set([os.path.split(i)[-1] for i in assigned])
-        # a = [i for i in np.setdiff1d(bucket_files, assigned) if os.path.split(i)[-1] in assigned_set]
-        # [os.path.split(i)[-1] for i in a]
-        #
-        # try:
-        #     assert attribute in samples_df.columns
-        # except:
-        #     raise ValueError('Sample attribute "{}" does not exist'.format(attribute))
-        #
-        # # make sure all samples have attribute set
-        # assert samples_df[attribute].isnull().sum()==0
-        #
-        # if ext is None:
-        #     ext = np.unique([os.path.split(i)[1].split('.',1)[1] for i in samples_df[attribute]])
-        #     assert len(ext)==1
-        #     ext = ext[0]
-        #
-        # purge_paths = [i for i in bucket_files if i.endswith(ext) and i not in set(samples_df[attribute])]
-        # if len(purge_paths)==0:
-        #     print('No outdated files to purge.')
-        # else:
-        #     bucket_id = self.get_bucket_id()
-        #     assert np.all([i.startswith('gs://'+bucket_id) for i in purge_paths])
-        #
-        #     while True:
-        #         s = input('{} outdated files found. Delete? [y/n] '.format(len(purge_paths))).lower()
-        #         if s=='n' or s=='y':
-        #             break
-        #
-        #     if s=='y':
-        #         print('Purging {} outdated files.'.format(len(purge_paths)))
-        #         gs_delete(purge_paths, chunk_size=500)
+            print('[dry-run] no files deleted (use delete=True).')
+        return orphan_df, summary_df
 
 
     def update_entity_attributes(self, etype, attrs):
@@ -1347,14 +1857,14 @@ class WorkspaceManager(object):
                 attr_list.extend([{
                     'name':row.name,
                     'entityType':etype,
-                    'operations': [{"op": "AddUpdateAttribute", "attributeName": i, "addUpdateAttribute":str(j)} for i,j in row.iteritems()]
+                    'operations': [{"op": "AddUpdateAttribute", "attributeName": i, "addUpdateAttribute":str(j)} for i,j in row.items()]
                 }])
         elif isinstance(attrs, pd.Series):
             attr_list = [{
                 'name':i,
                 'entityType':etype,
                 'operations': [{"op": "AddUpdateAttribute", "attributeName":attrs.name, "addUpdateAttribute":str(j)}]
-            } for i,j in attrs.iteritems()]
+            } for i,j in attrs.items()]
         else:
             raise ValueError('Unsupported input format.')
 
@@ -1380,10 +1890,156 @@ class WorkspaceManager(object):
 
 
     def create_submission(self, cnamespace, config, entity, etype, expression=None, use_callcache=True):
-        """Create submission"""
+        """Create submission (returns submission ID)"""
         r = firecloud.api.create_submission(self.namespace, self.workspace,
             cnamespace, config, entity, etype, expression=expression, use_callcache=use_callcache)
         if r.status_code==201:
-            print('Successfully created submission {}.'.format(r.json()['submissionId']))
+            submission_id = r.json()['submissionId']
+            print('Successfully created submission {}.'.format(submission_id))
+            return submission_id
         else:
             print(r.text)
+
+
+    def submit_many(self, cnamespace, config, entity_ids, etype, shard_size=500, max_inflight=4,
+                    max_active_workflows=None, shard_prefix=None, use_callcache=True, poll_interval=60):
+        """
+        Submit a large number of entities as a series of sharded submissions
+
+        The entities are split into sets of shard_size ({etype}_set entities
+        named {shard_prefix}_shard{k}), which are submitted with expression
+        this.{etype}s. At most max_inflight of these submissions are active at
+        any time, and new shards are held while the number of active workflows
+        in the workspace exceeds max_active_workflows.
+
+        Returns a DataFrame with the submission ID for each shard.
+        """
+        assert etype in ['sample', 'pair', 'participant']
+        entity_ids = list(pd.unique(np.asarray(entity_ids)))
+        if shard_prefix is None:
+            shard_prefix = '{}_{}'.format(config, datetime.now().strftime('%Y%m%d%H%M%S'))
+
+        # create all shard sets in a single upload
+        n = int(np.ceil(len(entity_ids)/shard_size))
+        shard_ids = ['{}_shard{}'.format(shard_prefix, k) for k in range(1, n+1)]
+        set_df = pd.DataFrame({
+            'membership:{}_set_id'.format(etype): np.repeat(shard_ids, shard_size)[:len(entity_ids)],
+            '{}_id'.format(etype): entity_ids,
+        })
+        self.upload_entities('{}_set'.format(etype), set_df, index=False)
+
+        tracking_df = pd.DataFrame(index=pd.Index(shard_ids, name='{}_set_id'.format(etype)),
+            columns=['entities', 'submission_id', 'submission_time'])
+        tracking_df['entities'] = set_df.groupby(set_df.columns[0]).size()
+        active_statuses = ['Queued', 'Submitted', 'Launching', 'Running', 'Aborting']
+
+        pending = list(shard_ids)
+        while pending:
+            submissions = self.list_submissions()
+            submitted = set(tracking_df['submission_id'].dropna())
+            inflight = len([s for s in submissions
+                if s['submissionId'] in submitted and s['status'] not in ['Done', 'Aborted']])
+            active_workflows = int(sum([s['workflowStatuses'].get(i, 0)
+                for s in submissions for i in active_statuses]))
+
+            while pending and inflight<max_inflight and (max_active_workflows is None
+                    or active_workflows<max_active_workflows):
+                shard_id = pending.pop(0)
+                submission_id = self.create_submission(cnamespace, config, shard_id, '{}_set'.format(etype),
+                    expression='this.{}s'.format(etype), use_callcache=use_callcache)
+                if submission_id is None:
+                    raise ValueError('Submission failed for shard {}.'.format(shard_id))
+                tracking_df.loc[shard_id, ['submission_id', 'submission_time']] = [submission_id, datetime.now()]
+                inflight += 1
+                active_workflows += int(tracking_df.loc[shard_id, 'entities'])
+
+            if pending:
+                print('\r  * {}/{} shards submitted, {} in flight, {} active workflows'.format(
+                    n-len(pending), n, inflight, active_workflows), end='')
+                time.sleep(poll_interval)
+        print('\nSubmitted {} entities in {} shards.'.format(len(entity_ids), n))
+        return tracking_df
+
+
+    def retry_failed(self, cnamespace, config, etype, submission_ids=None, max_attempts=3,
+                     batch_size=500, backoff=600, max_backoff=7200, poll_interval=300, **kwargs):
+        """
+        Watch the submissions of a configuration and resubmit failed entities
+        (with call caching) until they succeed or reach max_attempts
+
+        Failed entities are collected as submissions finish, and resubmitted
+        via submit_many once batch_size failures have accumulated or no
+        submissions remain active. Successive retry waves are separated by an
+        exponential backoff (backoff*2**(wave-1), capped at max_backoff seconds).
+
+        submission_ids: submissions to watch (default: all submissions of config)
+        kwargs: passed to submit_many
+
+        Returns a DataFrame with the final status and number of attempts per entity.
+        """
+        if submission_ids is None:
+            submission_ids = [s['submissionId'] for s in self.list_submissions(config=config)
+                if s['methodConfigurationName']==config]
+        watched = set(submission_ids)
+        finished = set()
+        attempts = defaultdict(int)
+        latest = {}  # entity -> (timestamp, status, submission_id)
+        pending = set()  # entities resubmitted, whose retry has not finished
+        wave = 0
+        last_wave = 0
+
+        while True:
+            # only refetch submissions that have not finished
+            active = 0
+            for submission_id in watched - finished:
+                r = self.get_submission(submission_id)
+                if r['status'] not in ['Done', 'Aborted']:
+                    active += 1
+                    continue
+                finished.add(submission_id)
+                ts = convert_time(r['submissionDate'])
+                for w in r['workflows']:
+                    if w['workflowEntity']['entityType']!=etype:
+                        continue
+                    entity_id = w['workflowEntity']['entityName']
+                    attempts[entity_id] += 1
+                    pending.discard(entity_id)
+                    if entity_id not in latest or latest[entity_id][0]<ts:
+                        latest[entity_id] = (ts, w['status'], submission_id)
+            if active==0 and pending:
+                # retry submissions finished without creating workflows for these entities
+                for i in pending:
+                    attempts[i] += 1
+                pending.clear()
+
+            failed = [i for i,(_,status,_) in latest.items()
+                      if status=='Failed' and attempts[i]<max_attempts and i not in pending]
+            print('\r  * {} submissions active, {} failed entities pending retry (wave {})'.format(
+                active, len(failed), wave), end='')
+            if len(failed)==0 and active==0:
+                break
+
+            wait = min(backoff*2**max(wave-1, 0), max_backoff) if wave>0 else 0
+            if failed and (len(failed)>=batch_size or active==0) and time.time()-last_wave>=wait:
+                wave += 1
+                print()
+                tracking_df = self.submit_many(cnamespace, config, failed, etype, shard_size=batch_size,
+                    shard_prefix='{}_retry{}_{}'.format(config, wave, datetime.now().strftime('%Y%m%d%H%M%S')),
+                    use_callcache=True, **kwargs)
+                watched.update(tracking_df['submission_id'].dropna())
+                pending.update(failed)  # prevent resubmission until the retry has finished
+                last_wave = time.time()
+            else:
+                time.sleep(poll_interval)
+        print()
+
+        status_df = pd.DataFrame({
+            'status':{i:j[1] for i,j in latest.items()},
+            'attempts':pd.Series(attempts),
+            'submission_id':{i:j[2] for i,j in latest.items()},
+        })
+        status_df.index.name = etype+'_id'
+        exhausted = status_df[(status_df['status']=='Failed') & (status_df['attempts']>=max_attempts)]
+        if exhausted.shape[0]>0:
+            print('{} {}s failed after {} attempts.'.format(exhausted.shape[0], etype, max_attempts))
+        return status_df
@@ -14,6 +14,7 @@ setup(
     name = 'firecloud-dalmatian',
     version = __version__,
     packages = find_packages(),
+    package_data = {'dalmatian': ['data/*.json']},
     description = 'A friendly companion for FISS',
     author = 'Broad Institute - Cancer Genome Computational Analysis',
     author_email = 'gdac@broadinstitute.org',
@@ -30,10 +31,15 @@ setup(
     'pytz',
     'firecloud',
     'ipython',
-    'iso8601'
+    'iso8601',
+    'requests',
+    'google-auth'
     ],
+    extras_require = {
+        'async': ['aiohttp'],
+    },
+    python_requires = '>=3.6',
     classifiers = [
-        "Programming Language :: Python :: 2",
         "Programming Language :: Python :: 3",
         "Intended Audience :: Science/Research",
         "Topic :: Scientific/Engineering :: Bio-Informatics",
@@ -0,0 +1,56 @@
+import asyncio
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+import dalmatian
+
+
+SAMPLES = [
+    {'name':'s{}'.format(i), 'entityType':'sample',
+     'attributes':{'participant':{'entityType':'participant', 'entityName':'p{}'.format(i)},
+                   'bam':'gs://bucket/s{}.bam'.format(i),
+                   'tags':{'itemsType':'AttributeValue', 'items':['a', 'b']}}}
+    for i in range(5)
+]
+
+
+async def _entity_query(request):
+    assert request.headers['Authorization']=='Bearer token'
+    page = int(request.query['page'])
+    page_size = int(request.query['pageSize'])
+    results = SAMPLES[(page-1)*page_size:page*page_size]
+    return web.json_response({'results':results,
+        'resultMetadata':{'filteredPageCount':(len(SAMPLES)+page_size-1)//page_size}})
+
+
+def _run_with_server(coro_func):
+    async def _main():
+        app = web.Application()
+        app.router.add_get('/workspaces/{namespace}/{workspace}/entityQuery/{etype}', _entity_query)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        async with aiohttp.ClientSession() as session:
+            wm = dalmatian.AsyncWorkspaceManager('ns', 'ws', root_url='http://127.0.0.1:{}/'.format(port),
+                token_provider=lambda: 'token', session=session)
+            try:
+                return await coro_func(wm)
+            finally:
+                await runner.cleanup()
+    return asyncio.run(_main())
+
+
+def test_get_entities_pages():
+    df = _run_with_server(lambda wm: wm.get_entities('sample', page_size=2))
+    assert df.index.name=='sample_id'
+    assert df.index.tolist()==['s{}'.format(i) for i in range(5)]
+    assert df.loc['s3', 'tags']==['a', 'b']
+    assert df.loc['s3', 'bam']=='gs://bucket/s3.bam'
+
+
+def test_get_samples():
+    df = _run_with_server(lambda wm: wm.get_samples())
+    assert df['participant'].tolist()==['p{}'.format(i) for i in range(5)]
@@ -0,0 +1,13 @@
+import numpy as np
+import pytest
+from dalmatian.pricing import PriceTable
+
+
+def test_unknown_machine_types():
+    pt = PriceTable()
+    with pytest.raises(ValueError):
+        pt.hourly_price('zz-standard-4')
+    with pytest.warns(UserWarning, match='zz-standard-4'):
+        cost = pt.price(['n1-standard-2', 'zz-standard-4', None], hours=2)
+    assert cost[0]==pytest.approx(2*pt.hourly_price('n1-standard-2'))
+    assert np.isnan(cost[1:]).all()
@@ -0,0 +1,76 @@
+import os
+import pandas as pd
+import pytest
+import dalmatian
+from dalmatian import wmanager
+from dalmatian.storage import LocalBackend, get_storage_backend, set_storage_backend
+
+
+class _Response(object):
+    status_code = 204
+    text = ''
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    backend = get_storage_backend()
+    set_storage_backend(LocalBackend(str(tmp_path/'buckets')))
+    yield tmp_path
+    set_storage_backend(backend)
+
+
+def test_sync_samples_without_participant(local_storage, monkeypatch):
+    updates = []
+    monkeypatch.setattr(wmanager, '_batch_update_entities',
+        lambda namespace, workspace, json_body: updates.append(json_body) or _Response())
+
+    for s in ['s1', 's2']:
+        (local_storage/'{}.bam'.format(s)).write_text(s)
+    df = pd.DataFrame({'bam':[str(local_storage/'s1.bam'), str(local_storage/'s2.bam')]},
+                      index=pd.Index(['s1', 's2'], name='sample_id'))
+
+    wm = dalmatian.WorkspaceManager('ns', 'ws')
+    sync_df = wm.sync_samples(df, 'gs://bucket/bams', checksum=False)
+
+    assert sync_df.shape[0]==2
+    assert os.path.isfile(str(local_storage/'buckets'/'bucket'/'bams'/'s1.bam'))
+    assert len(updates)==1
+    assert updates[0]==[
+        {'name':s, 'entityType':'sample', 'operations':[{'op':'AddUpdateAttribute', 'attributeName':'bam',
+            'addUpdateAttribute':'gs://bucket/bams/{}.bam'.format(s)}]}
+        for s in ['s1', 's2']]
+
+
+def _attempt(shard, hit, bam):
+    return {'start':'2020-01-01T00:00:00Z', 'end':'2020-01-01T02:00:00Z', 'preemptible':True,
+            'jes':{'machineType':'zones/n1-standard-4'}, 'shardIndex':shard,
+            'callCaching':{'hit':hit, 'result':'Cache Hit' if hit else 'Cache Miss',
+                           'effectiveCallCachingMode':'ReadAndWriteCache',
+                           'hashes':{'input':{'File bam':bam}, 'command template':'c'}}}
+
+
+def test_get_callcache_report_fetch_error():
+    metadata = {
+        'w1': {'calls':{'wf.align':[_attempt(0, False, 'b1')]}},
+        'w2': {'calls':{'wf.align':[_attempt(0, False, 'b2')]}},
+    }
+
+    def get_workflow_metadata(submission_id, workflow_id):
+        if workflow_id=='w3':
+            raise ValueError('metadata not available')
+        return metadata[workflow_id]
+
+    wm = dalmatian.WorkspaceManager('ns', 'ws')
+    wm.list_submissions = lambda config=None: [
+        {'submissionId':'s1', 'submissionDate':'2020-01-01T00:00:00Z'},
+        {'submissionId':'s2', 'submissionDate':'2020-01-02T00:00:00Z'}]
+    wm.get_submission = lambda submission_id: {'workflows':[
+        {'workflowId':'w1' if submission_id=='s1' else 'w2', 'status':'Succeeded', 'workflowEntity':{'entityName':'e1'}}]
+        + ([{'workflowId':'w3', 'status':'Failed', 'workflowEntity':{'entityName':'e2'}}] if submission_id=='s2' else [])}
+    wm.get_workflow_metadata = get_workflow_metadata
+
+    task_df, miss_df, error_df = wm.get_callcache_report('config', num_threads=2)
+    assert task_df.loc['align', 'calls']==2
+    assert miss_df['changed'].tolist()==[['input/File bam']]
+    assert error_df[['submission_id', 'workflow_id', 'entity_id']].values.tolist()==[['s2', 'w3', 'e2']]
+    assert 'metadata not available' in error_df.loc[0, 'error']